@@ -1,16 +1,30 @@
 import argparse
 import base64
+import codecs
+import contextlib
 import copy
+import functools
 import hashlib
+import inspect
+import io
+import itertools
+import json
+import mmap
+import operator
 import os
+import pickle
 import re
 import shlex
-import shutil
+import signal
+import sqlite3
 import string
-import tempfile
-from collections import defaultdict
+import sys
+import threading
+import time
+from collections import defaultdict, deque, namedtuple
+from collections.abc import MutableMapping
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 from urllib.parse import urlparse
-from simpleeval import simple_eval
 from types import SimpleNamespace
 
 # Allow args to be used across functions
@@ -25,12 +39,86 @@ default_arg_vals = {
 }
 cli_args = SimpleNamespace(**default_arg_vals)
 
+
+def make_options(options=None):
+    # Options of a deobfuscator, which default to `cli_args` at the time it is created. Taking a
+    # snapshot lets deobfuscators with different options run at the same time.
+    values = {key: getattr(cli_args, key, value) for key, value in default_arg_vals.items()}
+    if isinstance(options, dict):
+        unknown = set(options) - set(values)
+        if unknown:
+            raise TypeError(f"Unknown options: {', '.join(sorted(unknown))}")
+        values.update(options)
+    elif options is not None:
+        values.update({key: getattr(options, key) for key in values if hasattr(options, key)})
+    return SimpleNamespace(**values)
+
 QUOTED_CHARS = ["|", ">", "<", '"', "^", "&"]
+# Characters changed by `normalize_command`
+NORMALIZED_CHARS_RE = re.compile(r'["%!^,;]')
 
 # Powershell detection
-ENC_RE = rb"(?i)(?:-|/)e(?:c|n(?:c(?:o(?:d(?:e(?:d(?:c(?:o(?:m(?:m(?:a(?:nd?)?)?)?)?)?)?)?)?)?)?)?)?$"
-PWR_CMD_RE = rb"(?i)(?:-|/)c(?:o(?:m(?:m(?:a(?:nd?)?)?)?)?)?$"
-PWR_FILE_RE = rb"(?i)(?:-|/)f(?:i(?:l(?:e?)?)?)?$"
+ENC_RE = re.compile(
+  rb"(?i)(?:-|/)e(?:c|n(?:c(?:o(?:d(?:e(?:d(?:c(?:o(?:m(?:m(?:a(?:nd?)?)?)?)?)?)?)?)?)?)?)?)?$"
+)
+PWR_CMD_RE = re.compile(rb"(?i)(?:-|/)c(?:o(?:m(?:m(?:a(?:nd?)?)?)?)?)?$")
+PWR_FILE_RE = re.compile(rb"(?i)(?:-|/)f(?:i(?:l(?:e?)?)?)?$")
+
+# Patterns used while splitting and interpreting commands. They are compiled once here since
+# they are matched against every command of a sample.
+# TODO: Wrapping everything in () is wrong, but helps to analyze internal elements
+IF_STATEMENT_RE = re.compile(
+  r"(?P<conditional>(?P<if_statement>if)\s+(not\s+)?"
+  r"(?P<type>errorlevel\s+\d+\s+|exist\s+(\".*\"|[^\s]+)\s+|.+?==.+?\s+|"
+  r"(\/i\s+)?[^\s]+\s+(equ|neq|lss|leq|gtr|geq)\s+[^\s]+\s+|cmdextversion\s+\d\s+|defined\s+[^\s]+\s+)"
+  r"(?P<open_paren>\()?)(?P<true_statement_start>.*)",
+  re.IGNORECASE,
+)
+ELSE_STATEMENT_RE = re.compile(
+  r"(?P<close_paren>\))?(\s+else\s+(?P<open_paren>\()?\s*(?P<false_statement_start>.*)(?P<ending_paren>\))?)",
+  re.IGNORECASE,
+)
+FOR_STATEMENT_RE = re.compile(
+  r"(?P<loop>(?P<for_statement>for)\s+"
+  r"(?P<parameter>.+)"
+  r"\s+IN\s+\((?P<in_set>[^\)]+)\)"
+  r"\s+DO\s+"
+  r"(?P<open_paren>\()?)(?P<command>[^\)]*)(?P<close_paren>\))?",
+  re.IGNORECASE,
+)
+# This is where instances of a variable are replaced by their value
+STR_SUBSTITUTION_RE = re.compile(
+  r"([%!])(?P<variable>[\"^|!\w#$'()*+,-.?@\[\]`{}~\s+]+)"
+  r"("
+  r"(:~\s*(?P<index>[+-]?\d+)\s*(?:,\s*(?P<length>[+-]?\d+))?\s*)|"
+  r"(:(?P<s1>[^=]+)=(?P<s2>[^=]*))"
+  r")?(\1)",
+  re.MULTILINE,
+)
+# https://ss64.com/nt/start.html
+START_RE = re.compile(
+  r"start(.exe)?"
+  r"(\/min|\/max|\/wait|\/low|\/normal|\/abovenormal|\/belownormal|\/high|\/realtime|\/b|\/i|\/w|\s+)*"
+  # TODO: Add Node + Affinity options
+  # TODO: Add title + path keys
+  r"(?P<cmd>.*)",
+  re.IGNORECASE,
+)
+# Handle "cmd" command with various options
+CMD_RE = re.compile(
+  r"cmd(.exe)?\s*((\/A|\/U|\/Q|\/D)\s+|((\/E|\/F|\/V):(ON|OFF))\s*)*(\/c|\/r)\s*(?P<cmd>.*)",
+  re.IGNORECASE,
+)
+BACKSLASHES_RE = re.compile(r"\\+")
+# Match everything up to the next separator outside of quotes and not escaped, so that the regex
+# engine skips the text in between instead of looking at it one character at a time in Python
+UNTIL_COMMAND_SEPARATOR_RE = re.compile(r'(?:[^"^&|]+|"[^"]*"?|\^.?)*', re.DOTALL)
+UNTIL_CLOSING_PAREN_RE = re.compile(r'(?:[^"^)]+|"[^"]*"?|\^.?)*', re.DOTALL)
+# Runs of references to single characters, `%a%%b%%c%%d%` or `%alpha:~1,1%%alpha:~0,1%...`,
+# expanded at once by `expand_reference_run`. Shorter runs are cheaper through `get_value`.
+PLAIN_REFERENCE_RUN_RE = re.compile(r"(?:%[^\W\d]\w*%){4,}")
+SLICE_REFERENCE_RUN_RE = re.compile(r"%(?P<name>[^\W\d]\w*):~\d+,1%(?:%(?P=name):~\d+,1%){3,}", re.IGNORECASE)
+SLICE_INDEX_RE = re.compile(r":~(\d+),")
 
 # Gathered from https://gist.github.com/api0cradle/8cdc53e2a80de079709d28a2d96458c2
 RARE_LOLBAS = [
@@ -70,16 +158,843 @@ def variable_is_dynamic(variable: str) -> bool:
     return variable[:2] == "%="
 
 
+# Methods timed when profiling is enabled. The timers are cumulative and include the nested
+# stages, e.g. `normalize_command` includes `get_value`.
+PROFILED_STAGES = [
+  "get_commands",
+  "normalize_command",
+  "get_value",
+  "interpret_command",
+  "interpret_set",
+  "interpret_curl",
+  "interpret_powershell",
+  "interpret_mshta",
+  "interpret_rundll32",
+  "interpret_copy",
+]
+
+
+def profiled(stats, stage, function):
+    # Counts the calls to `function` and adds up the time spent in it to `stats[stage]`
+    stage_stats = stats.setdefault(stage, {"calls": 0, "seconds": 0.0})
+
+    if inspect.isgeneratorfunction(function):
+        # Only the time spent producing the items is counted, not the time the caller spends on them
+        @functools.wraps(function)
+        def generator_wrapper(*args, **kwargs):
+            stage_stats["calls"] += 1
+            iterator = function(*args, **kwargs)
+            while True:
+                start = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    stage_stats["seconds"] += time.perf_counter() - start
+                yield item
+
+        return generator_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stage_stats["calls"] += 1
+            stage_stats["seconds"] += time.perf_counter() - start
+
+    return wrapper
+
+
+BUILTIN_COMMANDS = {"call", "start", "set", "copy", "exit"}
+
+
+def canonical_command(command):
+    # "c:\windows\system32\cmd.exe" -> "cmd", the name under which the command is handled.
+    # Builtins of cmd such as `set` aren't programs, so they are only recognized by their exact name.
+    name = command.rpartition("\\")[2]
+    if name.endswith(".exe"):
+        name = name[:-4]
+    if name in BUILTIN_COMMANDS and name != command:
+        return None
+    return name
+
+
+# Source of versions for state shared with children, see `BatchDeobfuscator.set_variable`
+VERSION_COUNTER = itertools.count(1)
+# Number of expanded references kept by `BatchDeobfuscator.get_value` before starting over
+EXPANSION_CACHE_SIZE = 65536
+
+
+@functools.lru_cache(maxsize=None)
+def get_curl_parser():
+    # There are 211 lines coming out of curl --help, so we won't parse all the options
+    curl_parser = argparse.ArgumentParser()
+    # Data could be had multiple time, but since we don't use it, we can ignore it
+    curl_parser.add_argument("-d", "--data", dest="data", help="Data to send")
+    curl_parser.add_argument("-o", "--output", dest="output", help="Write to file instead of stdout")
+    curl_parser.add_argument("-H", "--header", dest="header", help="Extra header to include")
+    curl_parser.add_argument("-X", "--request", dest="command", default="GET", help="Specifies a custom request method")
+    curl_parser.add_argument(
+      "-O",
+      "--remote-name",
+      dest="remote_name",
+      action="store_true",
+      help="Write output to a file named as the remote file",
+    )
+    curl_parser.add_argument("url", help="URL")
+    # Patch all possible one-character arguments
+    for char in string.ascii_letters + string.digits + "#:":
+        try:
+            curl_parser.add_argument(f"-{char}", action="store_true")
+        except argparse.ArgumentError:
+            pass
+    return curl_parser
+
+
+@functools.lru_cache(maxsize=None)
+def get_invoke_webrequest_parser():
+    invoke_webrequest_parser = argparse.ArgumentParser()
+    # We may need to handle all possible casing for those
+    invoke_webrequest_parser.add_argument("-uri", dest="uri")
+    invoke_webrequest_parser.add_argument("-outfile", dest="outfile")
+    return invoke_webrequest_parser
+
+
+@functools.lru_cache(maxsize=1024)
+def substitution_pattern(search: str) -> re.Pattern:
+    # `%var:s1=s2%` is matched case insensitively, and samples tend to reuse the same few `s1`
+    return re.compile(re.escape(search), re.IGNORECASE)
+
+
+# `set /a` arithmetic, evaluated on 32-bit signed integers like cmd does:
+# https://ss64.com/nt/set.html#expressions
+ARITHMETIC_TOKEN_RE = re.compile(
+  r"\s*(?:(?P<number>\d\w*)|(?P<operator><<=|>>=|[-+*/%&^|]=|<<|>>|[-+*/%&^|()!~=,])"
+  r"|(?P<name>[^\s\d()!~*/%+\-<>&^|=,][^\s()!~*/%+\-<>&^|=,]*))"
+)
+# Decimal (17), hexadecimal (0x11) or octal (021)
+ARITHMETIC_LITERAL_RE = re.compile(r"0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*")
+ARITHMETIC_VALUE_RE = re.compile(r"\s*([-+]?)(0[xX][0-9a-fA-F]+|0[0-7]*|[1-9][0-9]*)")
+ARITHMETIC_ESCAPE_RE = re.compile(r"\^(.)")
+
+
+def to_int32(value):
+    value &= 0xFFFFFFFF
+    return value - 0x100000000 if value & 0x80000000 else value
+
+
+def arithmetic_divide(a, b):
+    # Truncated towards zero, like in C
+    if b == 0:
+        raise ZeroDivisionError("Divide by zero error.")
+    quotient = abs(a) // abs(b)
+    return to_int32(quotient if (a < 0) == (b < 0) else -quotient)
+
+
+def arithmetic_remainder(a, b):
+    # Has the sign of the dividend, like in C
+    if b == 0:
+        raise ZeroDivisionError("Divide by zero error.")
+    remainder = abs(a) % abs(b)
+    return remainder if a >= 0 else -remainder
+
+
+ARITHMETIC_OPERATORS = {
+  "*": lambda a, b: to_int32(a * b),
+  "/": arithmetic_divide,
+  "%": arithmetic_remainder,
+  "+": lambda a, b: to_int32(a + b),
+  "-": lambda a, b: to_int32(a - b),
+  # The shift count is masked, like the x86 instructions do
+  "<<": lambda a, b: to_int32(a << (b & 31)),
+  ">>": lambda a, b: a >> (b & 31),
+  "&": operator.and_,
+  "^": operator.xor,
+  "|": operator.or_,
+}
+ARITHMETIC_UNARY_OPERATORS = {
+  "-": lambda a: to_int32(-a),
+  "+": lambda a: a,
+  "~": operator.invert,
+  "!": lambda a: int(a == 0),
+}
+# Binary operators from the lowest precedence to the highest, as listed by `set /?`
+ARITHMETIC_PRECEDENCE = [("|",), ("^",), ("&",), ("<<", ">>"), ("+", "-"), ("*", "/", "%")]
+
+
+def arithmetic_literal(literal):
+    if literal[:2].lower() == "0x":
+        return int(literal[2:], 16)
+    if literal[0] == "0":
+        return int(literal, 8)
+    return int(literal)
+
+
+def arithmetic_value(value):
+    # The value of a variable used by name, 0 if it isn't a number
+    match = ARITHMETIC_VALUE_RE.match(value)
+    if match is None:
+        return 0
+    sign, literal = match.groups()
+    number = arithmetic_literal(literal)
+    return to_int32(-number if sign == "-" else number)
+
+
+class ArithmeticEnvironment(dict):
+    # Values of the variables read by an expression, looked up on first use, and the assignments it made
+    def __init__(self, variables):
+        super().__init__()
+        self.variables = variables
+        self.assigned = {}
+
+    def __missing__(self, name):
+        value = self[name] = arithmetic_value(self.variables.get(name, ""))
+        return value
+
+    def assign(self, name, value):
+        self[name] = self.assigned[name] = value
+        return value
+
+
+class ArithmeticParser:
+    # Recursive descent parser building a closure for every node, so that an expression is only
+    # parsed once however many times it's evaluated
+    def __init__(self, expression):
+        self.tokens = []
+        position = 0
+        expression = expression.rstrip()
+        while position < len(expression):
+            match = ARITHMETIC_TOKEN_RE.match(expression, position)
+            if match is None:
+                raise ValueError(f"Invalid operator in {expression!r}")
+            self.tokens.append((match.lastgroup, match.group(match.lastgroup)))
+            position = match.end()
+        self.index = 0
+
+    def peek(self, offset=0):
+        if self.index + offset < len(self.tokens):
+            return self.tokens[self.index + offset]
+        return (None, None)
+
+    def parse(self):
+        expression = self.sequence()
+        if self.index != len(self.tokens):
+            raise ValueError(f"Unexpected {self.peek()[1]!r}")
+        return expression
+
+    def sequence(self):
+        # `a=1, b=2`, whose value is the last one
+        expressions = [self.assignment()]
+        while self.peek()[1] == ",":
+            self.index += 1
+            expressions.append(self.assignment())
+        if len(expressions) == 1:
+            return expressions[0]
+
+        def evaluate(environment):
+            for expression in expressions:
+                value = expression(environment)
+            return value
+
+        return evaluate
+
+    def assignment(self):
+        kind, name = self.peek()
+        assignment_kind, assignment = self.peek(1)
+        if kind != "name" or assignment_kind != "operator" or not assignment.endswith("="):
+            return self.binary(0)
+        self.index += 2
+        name = name.lower()
+        value = self.assignment()
+        if assignment == "=":
+            return lambda environment: environment.assign(name, value(environment))
+        function = ARITHMETIC_OPERATORS[assignment[:-1]]
+        return lambda environment: environment.assign(name, function(environment[name], value(environment)))
+
+    def binary(self, level):
+        if level == len(ARITHMETIC_PRECEDENCE):
+            return self.unary()
+        left = self.binary(level + 1)
+        while True:
+            kind, token = self.peek()
+            if kind != "operator" or token not in ARITHMETIC_PRECEDENCE[level]:
+                return left
+            self.index += 1
+            left = binary_operation(ARITHMETIC_OPERATORS[token], left, self.binary(level + 1))
+
+    def unary(self):
+        kind, token = self.peek()
+        if kind == "operator" and token in ARITHMETIC_UNARY_OPERATORS:
+            self.index += 1
+            function = ARITHMETIC_UNARY_OPERATORS[token]
+            operand = self.unary()
+            return lambda environment: function(operand(environment))
+        return self.primary()
+
+    def primary(self):
+        kind, token = self.peek()
+        self.index += 1
+        if kind == "number":
+            # Numbers are limited to 32 bits, negative ones are written with the unary minus
+            if ARITHMETIC_LITERAL_RE.fullmatch(token) is None or arithmetic_literal(token) > 0xFFFFFFFF:
+                raise ValueError(f"Invalid number {token!r}")
+            value = to_int32(arithmetic_literal(token))
+            return lambda environment: value
+        if kind == "name":
+            name = token.lower()
+            return lambda environment: environment[name]
+        if token == "(":
+            expression = self.sequence()
+            if self.peek()[1] != ")":
+                raise ValueError("Missing closing parenthesis")
+            self.index += 1
+            return expression
+        raise ValueError(f"Missing operand before {token!r}")
+
+
+def binary_operation(function, left, right):
+    return lambda environment: function(left(environment), right(environment))
+
+
+@functools.lru_cache(maxsize=4096)
+def compile_arithmetic(expression):
+    """Compile a `set /a` expression into a function of an `ArithmeticEnvironment`.
+
+    Raises ValueError when cmd would reject the expression.
+    """
+    return ArithmeticParser(expression).parse()
+
+
+class VariableScope(MutableMapping):
+    """Copy-on-write layer over a parent mapping.
+
+    Reads fall through to the parent chain, while writes and deletions only touch this layer,
+    so a child `cmd /c` can be given its own environment without copying the parent one.
+    The parent must not be modified while the layer is in use.
+    """
+
+    # Past this many layers, lookups cost more than a one-off copy of the parent
+    MAX_DEPTH = 32
+
+    def __init__(self, parent):
+        depth = parent.depth + 1 if isinstance(parent, VariableScope) else 1
+        if depth > self.MAX_DEPTH:
+            parent = dict(parent)
+            depth = 1
+        self.parent = parent
+        self.depth = depth
+        self.local = {}
+        self.deleted = set()
+
+    def __getitem__(self, key):
+        if key in self.local:
+            return self.local[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.parent[key]
+
+    def __setitem__(self, key, value):
+        self.local[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.local.pop(key, None)
+        if key in self.parent:
+            self.deleted.add(key)
+
+    def __contains__(self, key):
+        return key in self.local or (key not in self.deleted and key in self.parent)
+
+    def __iter__(self):
+        yield from self.local
+        for key in self.parent:
+            if key not in self.local and key not in self.deleted:
+                yield key
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+
+class IndicatorMatcher:
+    """Finds every indicator of a list in a command.
+
+    Indicators are either plain patterns, reported under the "LOLBAS" trait, or
+    `(category, pattern)` tuples reported under their own trait. Matching is case insensitive.
+
+    Large lists are compiled into an Aho-Corasick automaton, which finds all of them in a single
+    pass over the command. Its Python loop per character only pays off past about two hundred
+    indicators (see benchmarks/bench_indicators.py), so smaller lists such as the default one are
+    scanned with one substring check per indicator. `automaton` forces either way.
+    """
+
+    # Number of indicators from which the automaton is used
+    AUTOMATON_THRESHOLD = 200
+
+    def __init__(self, indicators, automaton=None):
+        self.indicators = []
+        self.patterns = []
+        for indicator in indicators:
+            category, pattern = ("LOLBAS", indicator) if isinstance(indicator, str) else indicator
+            if not pattern:
+                continue
+            self.indicators.append((category, pattern))
+            self.patterns.append(pattern.lower())
+        if automaton is None:
+            automaton = len(self.indicators) >= self.AUTOMATON_THRESHOLD
+        self.goto = None
+        if automaton:
+            self.build_automaton()
+
+    def build_automaton(self):
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [()]
+        for index, pattern in enumerate(self.patterns):
+            node = 0
+            for char in pattern:
+                if char not in self.goto[node]:
+                    self.goto[node][char] = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append(())
+                node = self.goto[node][char]
+            self.output[node] += (index,)
+
+        # Breadth-first, so the failure link of a node is always resolved before its children
+        queue = list(self.goto[0].values())
+        for node in queue:
+            for char, child in self.goto[node].items():
+                fallback = self.fail[node]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                if node:
+                    self.fail[child] = self.goto[fallback].get(char, 0)
+                self.output[child] += self.output[self.fail[child]]
+                queue.append(child)
+
+    @classmethod
+    def from_file(cls, path):
+        # One indicator per line, optionally prefixed by its category and a tab.
+        # Empty lines and lines starting with "#" are ignored.
+        indicators = []
+        with open(path, "r", encoding="utf-8") as indicators_file:
+            for line in indicators_file:
+                line = line.rstrip("\r\n")
+                if not line.strip() or line.startswith("#"):
+                    continue
+                if "\t" in line:
+                    indicators.append(tuple(line.split("\t", 1)))
+                else:
+                    indicators.append(line)
+        return cls(indicators)
+
+    def find(self, text):
+        # Indicators are returned once each, in the order they were given
+        if self.goto is None:
+            text = text.lower()
+            return [indicator for indicator, pattern in zip(self.indicators, self.patterns) if pattern in text]
+        goto = self.goto
+        fail = self.fail
+        output = self.output
+        found = set()
+        node = 0
+        for char in text.lower():
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if output[node]:
+                found.update(output[node])
+        return [self.indicators[index] for index in sorted(found)]
+
+
+DEFAULT_INDICATORS = IndicatorMatcher(RARE_LOLBAS)
+
+# Bytes that can't appear anywhere in UTF-8, which are dropped when decoding. Long lines are
+# decoded by blocks, and the blocks only made of these bytes are skipped without decoding them.
+PADDING_BYTES = bytes([0xC0, 0xC1, *range(0xF5, 0x100)])
+PADDING_BLOCK_SIZE = 4096
+
+
+@contextlib.contextmanager
+def map_buffer(stream):
+    # Maps a binary file in memory rather than reading it, or reads the rest of the stream when it
+    # can't be mapped (e.g. empty files, pipes and in-memory streams)
+    try:
+        buffer = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) if stream.tell() == 0 else None
+    except (AttributeError, OSError, ValueError):
+        buffer = None
+    if buffer is None:
+        yield stream.read()
+        return
+    try:
+        yield buffer
+    finally:
+        buffer.close()
+
+
+def detect_encoding(buffer):
+    # UTF-16 is told apart by its NUL bytes, since the UTF-16 BOM alone is also found in front of
+    # UTF-8 content to confuse tools. Returns the encoding and the offset of the content.
+    head = bytes(buffer[:1026])
+    if head.startswith(codecs.BOM_UTF8):
+        return "utf-8", len(codecs.BOM_UTF8)
+    has_bom = head[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)
+    sample = head[2:] if has_bom else head[:1024]
+    half = len(sample) // 2
+    # A few characters are needed to tell, ASCII text has no NUL bytes at all
+    if half >= 4:
+        even_nuls = sample[0::2].count(0)
+        odd_nuls = sample[1::2].count(0)
+        if odd_nuls > half * 0.6 and even_nuls < half * 0.1:
+            return ("utf-16" if has_bom else "utf-16-le"), 0
+        if even_nuls > half * 0.6 and odd_nuls < half * 0.1:
+            return ("utf-16" if has_bom else "utf-16-be"), 0
+    return "utf-8", 0
+
+
+class TraitSummary:
+    """Aggregated form of a trait recorded for every command, in place of the list of records.
+
+    Keeps the number of records, the sum of their counts (for records that have one) and the
+    last few records as examples, so that its size doesn't grow with the output.
+    """
+
+    __slots__ = ("records", "total", "examples", "count_index")
+
+    def __init__(self, max_examples, count_index=None):
+        self.records = 0
+        self.total = 0
+        self.examples = deque(maxlen=max_examples)
+        self.count_index = count_index
+
+    def append(self, record):
+        self.records += 1
+        if self.count_index is not None:
+            self.total += record[self.count_index]
+        self.examples.append(record)
+
+    def extend(self, records):
+        self.records += len(records)
+        if self.count_index is not None:
+            self.total += sum(record[self.count_index] for record in records)
+        self.examples.extend(records)
+
+    def __len__(self):
+        return self.records
+
+    def __repr__(self):
+        return f"TraitSummary(records={self.records}, total={self.total}, examples={list(self.examples)!r})"
+
+
+class SummarizedTraits(defaultdict):
+    # Traits where the ones recorded for every command are summarized, created on first use
+    # like the lists of the other traits
+    SUMMARIZED = {
+      # (command, normalized command, number of variables used)
+      "var_used": 2,
+      # (command, normalized command)
+      "start_with_var": None,
+    }
+    max_examples = 16
+
+    def __missing__(self, key):
+        if key in self.SUMMARIZED:
+            value = self[key] = TraitSummary(self.max_examples, self.SUMMARIZED[key])
+            return value
+        return super().__missing__(key)
+
+
+class HashingWriter:
+    """Text sink that hashes and buffers what is written, in place of a temporary file."""
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.chunks = []
+        self.line_count = 0
+
+    def write(self, text):
+        data = text.encode("utf-8")
+        self.sha256.update(data)
+        self.line_count += data.count(b"\n")
+        self.chunks.append(data)
+
+    def hexdigest(self):
+        return self.sha256.hexdigest()
+
+    def getvalue(self):
+        return b"".join(self.chunks)
+
+
+class ArtifactStore:
+    """Files produced by one analysis, kept in memory and/or written to a working directory.
+
+    Extracted files are content-addressed: a file whose sha256 was already stored is neither
+    written nor listed again, and is counted in `hits` instead. `analyzed_children` holds the keys of
+    the child commands already analyzed, so that repeated children can be skipped entirely.
+    """
+
+    def __init__(self, working_directory=None, keep_contents=True):
+        self.working_directory = working_directory
+        self.keep_contents = keep_contents
+        self.extracted_files = defaultdict(list)
+        self.contents = {}
+        self.hashes = set()
+        self.analyzed_children = set()
+        self.hits = defaultdict(int)
+
+    def add(self, file_type, filename, data, sha256hash):
+        if file_type is not None:
+            if (file_type, sha256hash) in self.hashes:
+                self.hits[file_type] += 1
+                return False
+            self.hashes.add((file_type, sha256hash))
+        if self.keep_contents:
+            self.contents[filename] = data
+        if self.working_directory is not None:
+            with open(os.path.join(self.working_directory, filename), "wb") as f:
+                f.write(data)
+        if file_type is not None:
+            self.extracted_files[file_type].append((filename, sha256hash))
+        return True
+
+
+# Bumped whenever the cached entries change in a way older versions can't read
+CACHE_VERSION = 1
+DEFAULT_CACHE_SIZE = 256 * 1024 * 1024
+# The options that change the results, the others such as `file` only matter to the command line
+CACHED_OPTIONS = ("verbose", "exitcodes", "math")
+# The name of the deobfuscated script (or its text), the traits, the extracted files by type and
+# the content of every artifact by name
+CacheEntry = namedtuple("CacheEntry", ["output", "traits", "extracted_files", "contents"])
+
+
+def handler_name(handler):
+    # Handlers without a name, such as partials, are told apart by their address only
+    qualname = getattr(handler, "__qualname__", None)
+    return f"{handler.__module__}.{qualname}" if qualname is not None else repr(handler)
+
+
+@functools.lru_cache(maxsize=None)
+def code_fingerprint():
+    # Results cached by another version of the deobfuscator are never used
+    with open(__file__, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+class ResultCache:
+    """Results of previous analyses in a SQLite database, shared across runs and processes.
+
+    Entries are looked up by the sha256 of the input along with a fingerprint of the code and of the
+    settings of the deobfuscator, so the same sample under another name is a hit. The least recently
+    used entries are evicted once they take more than `max_bytes`. Entries are pickled, so the
+    database should be trusted like the code itself. Errors of the database and entries that can't
+    be unpickled are counted as misses. A cache can be shared by the threads of a process.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        # The connection is shared by the threads, one statement at a time
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self.connection:
+            # Readers don't wait on writers, and commits don't wait on the disk
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute(
+              "CREATE TABLE IF NOT EXISTS results"
+              " (key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, used REAL NOT NULL)"
+            )
+            self.connection.execute("CREATE INDEX IF NOT EXISTS results_used ON results (used)")
+            # Running total of the sizes, kept up to date by every change of the results so that
+            # storing an entry doesn't have to sum them all
+            self.connection.execute("CREATE TABLE IF NOT EXISTS totals (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.connection.execute(
+              "INSERT OR IGNORE INTO totals SELECT 'size', CAST(total(size) AS INTEGER) FROM results"
+            )
+
+    def get(self, key):
+        with self.lock:
+            try:
+                row = self.connection.execute("SELECT value FROM results WHERE key = ?", (key,)).fetchone()
+                if row is not None:
+                    with self.connection:
+                        self.connection.execute("UPDATE results SET used = ? WHERE key = ?", (time.time(), key))
+            except sqlite3.Error:
+                row = None
+            try:
+                entry = pickle.loads(row[0]) if row is not None else None
+            except Exception:
+                # Corrupt, or pickled with classes that have changed since
+                entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return entry
+
+    def put(self, key, entry):
+        value = pickle.dumps(entry, pickle.HIGHEST_PROTOCOL)
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            try:
+                with self.connection:
+                    # Writing first takes the lock of the database, so the size of the entry being
+                    # replaced can't change in the meantime
+                    self.connection.execute(
+                      "UPDATE totals SET value = value + ? - coalesce((SELECT size FROM results WHERE key = ?), 0)"
+                      " WHERE name = 'size'",
+                      (len(value), key),
+                    )
+                    self.connection.execute(
+                      "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?)", (key, value, len(value), time.time())
+                    )
+                    self.evict()
+            except sqlite3.Error:
+                pass
+
+    def evict(self):
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        stale = []
+        freed = 0
+        for key, size in self.connection.execute("SELECT key, size FROM results ORDER BY used"):
+            if freed >= excess:
+                break
+            stale.append((key,))
+            freed += size
+        self.connection.executemany("DELETE FROM results WHERE key = ?", stale)
+        self.connection.execute("UPDATE totals SET value = value - ? WHERE name = 'size'", (freed,))
+
+    def size(self):
+        # Total size of the pickled entries. Not locked, since `put` calls it with the lock held.
+        return self.connection.execute("SELECT value FROM totals WHERE name = 'size'").fetchone()[0]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT count(*) FROM results").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@functools.lru_cache(maxsize=None)
+def open_cache(path, max_bytes=DEFAULT_CACHE_SIZE):
+    # One connection per process, for the corpus workers
+    return ResultCache(path, max_bytes)
+
+
+class BudgetExceeded(Exception):
+    # Raised when a sample goes over one of the limits of its budget, `limit` tells which one
+    def __init__(self, limit):
+        super().__init__(f"{limit} exceeded")
+        self.limit = limit
+
+
+class Budget:
+    # Limits of the work spent on a single sample, shared by a deobfuscator and its children.
+    # Limits set to None are disabled.
+    def __init__(self, max_command_length=None, max_output_bytes=None, max_commands=None, timeout=None):
+        self.max_command_length = sys.maxsize if max_command_length is None else max_command_length
+        self.max_output_bytes = sys.maxsize if max_output_bytes is None else max_output_bytes
+        self.max_commands = sys.maxsize if max_commands is None else max_commands
+        self.timeout = timeout
+        self.start()
+
+
+    def start(self):
+        # Called at the start of every sample
+        self.commands = 0
+        self.output_bytes = 0
+        self.deadline = None if self.timeout is None else time.monotonic() + self.timeout
+
+
+    def check_deadline(self):
+        if self.deadline is not None and time.monotonic() > self.deadline:
+            raise BudgetExceeded("timeout")
+
+
+    def check_command_length(self, command):
+        if len(command) > self.max_command_length:
+            raise BudgetExceeded("max_command_length")
+
+
+    def spend_command(self, normalized_comm):
+        # Called for every command before it is interpreted and added to the output
+        self.commands += 1
+        if self.commands > self.max_commands:
+            raise BudgetExceeded("max_commands")
+        self.output_bytes += len(normalized_comm.encode("utf-8"))
+        if self.output_bytes > self.max_output_bytes:
+            raise BudgetExceeded("max_output_bytes")
+        self.check_deadline()
+
+
 class BatchDeobfuscator:
-    def __init__(self, complex_one_liner_threshold=4):
+    def __init__(
+      self,
+      complex_one_liner_threshold=4,
+      indicators=None,
+      max_depth=256,
+      max_nested_work=10000,
+      max_command_length=None,
+      max_output_bytes=None,
+      max_commands=None,
+      timeout=None,
+      profile=False,
+      options=None,
+      full_traits=False,
+      max_trait_examples=16,
+      cache=None,
+    ):
         self.file_path = None
+        # A ResultCache used by `analyze` and `handle_bat_file`
+        self.cache = cache
+        # `math`, `exitcodes` and `verbose`, given as a dict or a namespace such as the command line
+        # arguments. Children share the options of their parent.
+        self.options = make_options(options)
+        self.indicators = DEFAULT_INDICATORS if indicators is None else indicators
         self.variables = {}
         self.exit_code = 0
         self.exec_cmd = []
         self.exec_ps1 = []
-        self.traits = defaultdict(list)
+        # The traits recorded for every command are summarized unless all the records are requested
+        self.full_traits = full_traits
+        self.max_trait_examples = max_trait_examples
+        self.traits = self.new_traits()
         self.complex_one_liner_threshold = complex_one_liner_threshold
+        # Budget for the nested variable expansions, command groups and children, past which the
+        # nested content is left as is and a "nesting-limit" trait is recorded
+        self.max_depth = max_depth
+        self.max_nested_work = max_nested_work
+        # Going over the budget stops the analysis of the sample, and is recorded in the
+        # "budget-exceeded" trait. Children spend the budget of their parent.
+        self.budget = Budget(max_command_length, max_output_bytes, max_commands, timeout)
+        # Calls and cumulative seconds per stage when profiling, shared with the children
+        self.profile_stats = None
+        if profile:
+            self.enable_profiling({})
         self.modified_filesystem = {}
+        self.filesystem_version = 0
+        self.variable_versions = {}
+        self.expansion_cache = {}
+        self.expansion_cache_stats = {"hits": 0, "misses": 0}
         if os.name == "nt":
             for env_var, value in os.environ.items():
                 self.variables[env_var.lower()] = value
@@ -137,84 +1052,246 @@ class BatchDeobfuscator:
               "__compat_layer": "DetectorsMessageBoxErrors",
             }
 
-        # There are 211 lines coming out of curl --help, so we won't parse all the options
-        self.curl_parser = argparse.ArgumentParser()
-        # Data could be had multiple time, but since we don't use it, we can ignore it
-        self.curl_parser.add_argument("-d", "--data", dest="data", help="Data to send")
-        self.curl_parser.add_argument("-o", "--output", dest="output", help="Write to file instead of stdout")
-        self.curl_parser.add_argument("-H", "--header", dest="header", help="Extra header to include")
-        self.curl_parser.add_argument(
-          "-X", "--request", dest="command", default="GET", help="Specifies a custom request method"
-        )
-        self.curl_parser.add_argument(
-          "-O",
-          "--remote-name",
-          dest="remote_name",
-          action="store_true",
-          help="Write output to a file named as the remote file",
+
+    # The parsers are only built once per process, the first time they are needed, and are
+    # shared by every instance since parsing doesn't modify them
+    @property
+    def curl_parser(self):
+        return get_curl_parser()
+
+
+    @property
+    def powershell_invoke_webrequest_parser(self):
+        return get_invoke_webrequest_parser()
+
+
+    # Variables should be changed through these methods rather than directly in `variables`,
+    # so that the cached expansions depending on them are invalidated
+    def set_variable(self, var_name, value):
+        self.variables[var_name] = value
+        self.variable_versions[var_name] = next(VERSION_COUNTER)
+
+
+    def unset_variable(self, var_name):
+        if var_name in self.variables:
+            del self.variables[var_name]
+            self.variable_versions[var_name] = next(VERSION_COUNTER)
+
+
+    def modify_file(self, path, change):
+        self.modified_filesystem[path.lower()] = change
+        # Versions are unique across instances, so they also tell apart the filesystems of children
+        self.filesystem_version = next(VERSION_COUNTER)
+
+
+    def child_key(self, child_cmd):
+        # A child only depends on the variables it references, which would still be in its command,
+        # and on the files modified so far. Children with references are not deduplicated.
+        if "%" in child_cmd or "!" in child_cmd:
+            return None
+        return hashlib.sha256(f"{self.filesystem_version}:{child_cmd}".encode("utf-8")).digest()
+
+
+    def cache_key(self, kind, data):
+        # Only the first sample of a deobfuscator is cached, since the ones after it depend on the
+        # variables and files it left behind, and its traits would include theirs
+        if self.cache is None or self.traits or self.variable_versions or self.modified_filesystem or self.exit_code:
+            return None
+        settings = (
+          CACHE_VERSION,
+          code_fingerprint(),
+          kind,
+          [getattr(self.options, key) for key in CACHED_OPTIONS],
+          self.complex_one_liner_threshold,
+          self.max_depth,
+          self.max_nested_work,
+          self.budget.max_command_length,
+          self.budget.max_output_bytes,
+          self.budget.max_commands,
+          self.full_traits,
+          self.max_trait_examples,
+          getattr(self.indicators, "indicators", self.indicators),
+          # Subclasses and registered handlers change what is recorded
+          f"{type(self).__module__}.{type(self).__qualname__}",
+          sorted((name, handler_name(handler)) for name, handler in self.command_handlers.items()),
         )
-        self.curl_parser.add_argument("url", help="URL")
-        # Patch all possible one-character arguments
-        for char in string.ascii_letters + string.digits + "#:":
+        fingerprint = hashlib.sha256(repr(settings).encode("utf-8")).hexdigest()[:32]
+        return f"{kind}:{fingerprint}:{hashlib.sha256(data).hexdigest()}"
+
+
+    def cache_result(self, key, entry):
+        # Timeouts depend on the load of the machine rather than on the sample
+        if key is not None and self.traits.get("budget-exceeded") != "timeout":
+            self.cache.put(key, entry)
+
+
+    def new_traits(self):
+        if self.full_traits:
+            return defaultdict(list)
+        traits = SummarizedTraits(list)
+        traits.max_examples = self.max_trait_examples
+        return traits
+
+
+    def enable_profiling(self, stats):
+        # The profiled methods are only replaced on this instance, so profiling costs nothing
+        # to the instances that don't use it
+        self.profile_stats = stats
+        for stage in PROFILED_STAGES:
+            method = getattr(type(self), stage).__get__(self)
+            setattr(self, stage, profiled(stats, stage, method))
+
+
+    def spawn_child(self):
+        # Used for `cmd /c` children: the child sees the current variables and filesystem through
+        # copy-on-write scopes, and shares everything that is read-only such as the parsers.
+        # Versions are unique, so the expansion cache stays valid for both and is shared too.
+        # Traits gathered by a child were never reported, so it starts with an empty table.
+        child = copy.copy(self)
+        child.variables = VariableScope(self.variables)
+        child.variable_versions = VariableScope(self.variable_versions)
+        child.modified_filesystem = VariableScope(self.modified_filesystem)
+        child.traits = child.new_traits()
+        child.exec_cmd = []
+        child.exec_ps1 = list(self.exec_ps1)
+        if self.profile_stats is not None:
+            # The copied methods are still bound to the parent
+            child.enable_profiling(self.profile_stats)
+        return child
+
+
+    def run_nested(self, frame, stage):
+        # Nested expansions, command groups and children are generators that yield a nested frame
+        # along with a fallback result instead of recursing, so arbitrarily nested input can't
+        # exhaust the interpreter's stack. The result of the nested frame is sent back to its parent.
+        frames = [frame]
+        work = 0
+        steps = 0
+        result = None
+        while True:
+            steps += 1
+            if not steps % 1024:
+                self.budget.check_deadline()
             try:
-                self.curl_parser.add_argument(f"-{char}", action="store_true")
-            except argparse.ArgumentError:
-                pass
+                nested, fallback = frames[-1].send(result)
+            except StopIteration as stop:
+                frames.pop()
+                if not frames:
+                    return stop.value
+                result = stop.value
+                continue
+            if nested is None:
+                # Nothing to do in a nested frame
+                result = fallback
+                continue
+            # Only count the work below the first level, which is bounded by the size of the input
+            if len(frames) > 1:
+                work += 1
+            if len(frames) >= self.max_depth or work > self.max_nested_work:
+                nested.close()
+                self.nesting_limit_reached(stage, len(frames) >= self.max_depth)
+                result = fallback
+            else:
+                frames.append(nested)
+                result = None
 
-        self.powershell_invoke_webrequest_parser = argparse.ArgumentParser()
-        # We may need to handle all possible casing for those
-        self.powershell_invoke_webrequest_parser.add_argument("-uri", dest="uri")
-        self.powershell_invoke_webrequest_parser.add_argument("-outfile", dest="outfile")
 
+    def nesting_limit_reached(self, stage, depth):
+        self.traits["nesting-limit"].append(
+          {"Limit": "max_depth" if depth else "max_nested_work", "Stage": stage}
+        )
 
-    def read_logical_line(self, path):
-        with open(path, "r", encoding="utf-8", errors="ignore") as input_file:
-            logical_line = ""
-            for line in input_file:
-                if not line.endswith("^"):
-                    logical_line += line
-                    yield logical_line
-                    logical_line = ""
+
+    def join_logical_lines(self, lines):
+        logical_line = ""
+        for line in lines:
+            if not line.endswith("^"):
+                logical_line += line
+                yield logical_line
+                logical_line = ""
+            else:
+                logical_line += line + "\n"
+
+
+    def decode_lines(self, buffer):
+        # Yields the lines of a bytes-like object, such as a memory-mapped file. Lines are found at
+        # the byte level and only decoded one at a time, from slices of the buffer.
+        encoding, offset = detect_encoding(buffer)
+        if encoding != "utf-8":
+            self.traits["encoding"] = encoding
+            yield from io.StringIO(str(buffer, encoding, "ignore"), newline=None)
+            return
+
+        # Newlines are found with `find`, which runs in C, remembering where the next "\r" and
+        # "\n" are so that a file with a single kind of newline is only scanned once
+        view = memoryview(buffer)
+        try:
+            start = offset
+            size = len(buffer)
+            next_cr = next_lf = -2
+            after_cr = False
+            while start < size:
+                if -1 < next_cr < start or next_cr == -2:
+                    next_cr = buffer.find(b"\r", start)
+                if -1 < next_lf < start or next_lf == -2:
+                    next_lf = buffer.find(b"\n", start)
+                if next_cr == -1 and next_lf == -1:
+                    line = self.decode_line(view, start, size)
+                    if line:
+                        yield line
+                    break
+                if next_lf == -1 or -1 < next_cr < next_lf:
+                    end = next_cr
+                    next_start = end + 2 if next_lf == end + 1 else end + 1
                 else:
-                    logical_line += line + "\n"
+                    end = next_lf
+                    next_start = end + 1
+                line = self.decode_line(view, start, end)
+                # Text that is dropped when decoding can't separate "\r" from "\n"
+                if not (after_cr and not line and end == next_lf):
+                    yield line + "\n"
+                after_cr = next_start == end + 1 and end == next_cr
+                start = next_start
+        finally:
+            view.release()
+
+
+    def decode_line(self, view, start, end):
+        if end - start < PADDING_BLOCK_SIZE * 2:
+            return str(view[start:end], "utf-8", "ignore")
+        decoder = codecs.getincrementaldecoder("utf-8")("ignore")
+        parts = []
+        skipped = 0
+        for block_start in range(start, end, PADDING_BLOCK_SIZE):
+            block = view[block_start : min(block_start + PADDING_BLOCK_SIZE, end)]
+            if (
+              block[0] in PADDING_BYTES
+              and block[-1] in PADDING_BYTES
+              and not block.tobytes().translate(None, PADDING_BYTES)
+            ):
+                # Anything incomplete before the padding would be dropped by it
+                parts.append(decoder.decode(b"", True))
+                decoder.reset()
+                skipped += len(block)
+            else:
+                parts.append(decoder.decode(block))
+        parts.append(decoder.decode(b"", True))
+        if skipped:
+            self.traits["skipped-padding"] = self.traits.get("skipped-padding", 0) + skipped
+        return "".join(parts)
 
 
-    def find_closing_paren(self, statement):
-        state = "init"
-        counter = 0
-        start_command = 0
-        for char in statement:
-            if state == "init":
-                if char == '"':
-                    # Quote is on
-                    state = "quote_start"
-                elif char == "^":
-                    state = "escape"
-                elif char == ")":
-                    return statement[start_command:counter]
-            elif state == "quote_start":
-                if char == '"':
-                    state = "init"
-            elif state == "escape":
-                state = "init"
+    def read_logical_line(self, path):
+        with open(path, "rb") as input_file, map_buffer(input_file) as buffer:
+            yield from self.join_logical_lines(self.decode_lines(buffer))
 
-            counter += 1
 
-        return statement
+    def find_closing_paren(self, statement):
+        return statement[: UNTIL_CLOSING_PAREN_RE.match(statement).end()]
 
 
     def split_if_statement(self, statement):
-        # TODO: Wrapping everything in () is wrong, but helps to analyze internal elements
-        if_statement = (
-          r"(?P<conditional>(?P<if_statement>if)\s+(not\s+)?"
-          r"(?P<type>errorlevel\s+\d+\s+|exist\s+(\".*\"|[^\s]+)\s+|.+?==.+?\s+|"
-          r"(\/i\s+)?[^\s]+\s+(equ|neq|lss|leq|gtr|geq)\s+[^\s]+\s+|cmdextversion\s+\d\s+|defined\s+[^\s]+\s+)"
-          r"(?P<open_paren>\()?)(?P<true_statement_start>.*)"
-        )
-        else_statement = (
-          r"(?P<close_paren>\))?(\s+else\s+(?P<open_paren>\()?\s*(?P<false_statement_start>.*)(?P<ending_paren>\))?)"
-        )
-        if_match = re.search(if_statement, statement, re.IGNORECASE)
+        if_match = IF_STATEMENT_RE.search(statement)
         if if_match is not None:
             true_statement_start = if_match.span("true_statement_start")[0]
             rest = statement[true_statement_start:]
@@ -227,9 +1304,7 @@ class BatchDeobfuscator:
                 # If we are analysing only the first part, we're done after this
                 return
             yield true_statement
-            else_match = re.search(
-              else_statement, statement[true_statement_start + len(true_statement) :], re.IGNORECASE
-            )
+            else_match = ELSE_STATEMENT_RE.search(statement[true_statement_start + len(true_statement) :])
             if else_match is None:
                 if statement[true_statement_start + len(true_statement) :]:
                     yield statement[true_statement_start + len(true_statement) :]
@@ -261,14 +1336,7 @@ class BatchDeobfuscator:
 
 
     def split_for_statement(self, statement):
-        for_statement = (
-          r"(?P<loop>(?P<for_statement>for)\s+"
-          r"(?P<parameter>.+)"
-          r"\s+IN\s+\((?P<in_set>[^\)]+)\)"
-          r"\s+DO\s+"
-          r"(?P<open_paren>\()?)(?P<command>[^\)]*)(?P<close_paren>\))?"
-        )
-        match = re.search(for_statement, statement, re.IGNORECASE)
+        match = FOR_STATEMENT_RE.search(statement)
         if match is not None:
             loop = match.group("loop")
             if match.group("open_paren") is None:
@@ -300,32 +1368,22 @@ class BatchDeobfuscator:
             yield logical_line.strip()
             return
         
-        state = "init"
-        counter = 0
         start_command = 0
-        for char in logical_line:
-            if state == "init":
-                if char == '"':
-                    # Quote is on
-                    state = "quote_start"
-                elif char == "^":
-                    state = "escape"
-                elif char == "&" and logical_line[counter - 1] == ">":
-                    # Usually an output redirection, we want to keep it on the same line
-                    pass
-                elif char == "&" or char == "|":
-                    cmd = logical_line[start_command:counter].strip()
-                    if cmd != "":
-                        for part in self.get_commands_special_statement(cmd):
-                            yield part
-                    start_command = counter + 1
-            elif state == "quote_start":
-                if char == '"':
-                    state = "init"
-            elif state == "escape":
-                state = "init"
-
+        counter = 0
+        while True:
+            counter = UNTIL_COMMAND_SEPARATOR_RE.match(logical_line, counter).end()
+            if counter == len(logical_line):
+                break
+            if logical_line[counter] == "&" and logical_line[counter - 1] == ">":
+                # Usually an output redirection, we want to keep it on the same line
+                counter += 1
+                continue
+            cmd = logical_line[start_command:counter].strip()
+            if cmd != "":
+                for part in self.get_commands_special_statement(cmd):
+                    yield part
             counter += 1
+            start_command = counter
 
         # Remove leading spaces and trailing newlines
         last_com = logical_line[start_command:].lstrip(" ").rstrip("\n")
@@ -335,19 +1393,34 @@ class BatchDeobfuscator:
 
 
     def get_value(self, variable):
-        # This is where instances of a variable are replaced by their value
-        str_substitution = (
-          r"([%!])(?P<variable>[\"^|!\w#$'()*+,-.?@\[\]`{}~\s+]+)"
-          r"("
-          r"(:~\s*(?P<index>[+-]?\d+)\s*(?:,\s*(?P<length>[+-]?\d+))?\s*)|"
-          r"(:(?P<s1>[^=]+)=(?P<s2>[^=]*))"
-          r")?(\1)"
-        )
-        matches = re.finditer(str_substitution, variable, re.MULTILINE)
+        # Obfuscators repeat the same references (typically `%var:~n,1%`) thousands of times
+        # between two `set`, so expansions are cached with the version of every variable they read
+        cached = self.expansion_cache.get(variable)
+        if cached is not None:
+            value, dependencies = cached
+            for var_name, version in dependencies:
+                if self.variable_versions.get(var_name, 0) != version:
+                    break
+            else:
+                self.expansion_cache_stats["hits"] += 1
+                return value
+        self.expansion_cache_stats["misses"] += 1
+
+        dependencies = []
+        value = self.expand_reference(variable, dependencies)
+        if len(self.expansion_cache) >= EXPANSION_CACHE_SIZE:
+            self.expansion_cache.clear()
+        self.expansion_cache[variable] = (value, tuple(dependencies))
+        return value
+
+
+    def expand_reference(self, variable, dependencies):
+        matches = STR_SUBSTITUTION_RE.finditer(variable)
 
         value = ""
         for _, match in enumerate(matches):
             var_name = match.group("variable").lower()
+            dependencies.append((var_name, self.variable_versions.get(var_name, 0)))
             if var_name in self.variables:
                 value = self.variables[var_name]
                 if variable_is_dynamic(value):
@@ -375,8 +1448,7 @@ class BatchDeobfuscator:
                     if s1.startswith("*") and s1[1:].lower() in value.lower():
                         value = f"{s2}{value[value.lower().index(s1[1:].lower()) + len(s1)-1:]}"
                     else:
-                        pattern = re.compile(re.escape(s1), re.IGNORECASE)
-                        value = pattern.sub(re.escape(s2), value)
+                        value = substitution_pattern(s1).sub(re.escape(s2), value)
             else:
                 # It should be "variable", and interpret the empty echo later, but that would need a better simulator
                 return value
@@ -417,6 +1489,7 @@ class BatchDeobfuscator:
                     var_name += char
             elif state == "option":
                 option = char.lower()
+                option_end = idx + 1
                 state = "init"
             elif state == "var":
                 if char == "=":
@@ -463,17 +1536,14 @@ class BatchDeobfuscator:
 
         if option == "a":
             # Arithmetic expression: https://ss64.com/nt/set.html#expressions
+            if self.options.math:
+                assignment = self.evaluate_arithmetic(cmd[option_end:])
+                if assignment is not None:
+                    return assignment
             var_name = var_name.strip(" ")
             for char in QUOTED_CHARS:
                 var_name = var_name.replace(char, "")
             var_value = f"({var_value.strip(' ')})"
-            if cli_args.math:
-                # Convert the batch modulus operator to the Python one
-                math_value = var_value.replace("%%", "%")
-                # Attempt to evaluate the expression
-                math_eval = simple_eval(math_value[1:-1])
-                if math_eval is not None:
-                    var_value = str(math_eval)
         elif option == "p":
             last_quote_index = max(var_value.rfind("'"), var_value.rfind('"'))
             set_in = var_value.rfind("<")
@@ -489,7 +1559,7 @@ class BatchDeobfuscator:
                 if content[0] == content[-1] in ["'", '"']:
                     content = content[1:-1].strip()
                 file_redirect = file_redirect.strip()
-                self.modified_filesystem[file_redirect.lower()] = {"type": "content", "content": content}
+                self.modify_file(file_redirect, {"type": "content", "content": content})
                 self.traits["setp-file-redirection"].append((cmd, file_redirect))
 
             if set_in == -1 or set_in < last_quote_index:
@@ -513,6 +1583,24 @@ class BatchDeobfuscator:
         return (var_name, var_value)
 
 
+    def evaluate_arithmetic(self, expression):
+        # Makes the assignments of a `set /a` expression but the last one, which is returned for
+        # `handle_set` to make. Returns None when cmd would reject the expression.
+        expression = ARITHMETIC_ESCAPE_RE.sub(r"\1", expression).replace('"', "").replace("%%", "%")
+        environment = ArithmeticEnvironment(self.variables)
+        try:
+            compile_arithmetic(expression)(environment)
+        except (ValueError, ZeroDivisionError, RecursionError):
+            return None
+        if not environment.assigned:
+            # Only displays the result on the command line
+            return ("", "")
+        *assignments, last = environment.assigned.items()
+        for var_name, value in assignments:
+            self.set_variable(var_name, str(value))
+        return (last[0], str(last[1]))
+
+
     def interpret_curl(self, cmd):
         # Batch specific obfuscation that is not handled before for echo/variable purposes, can be stripped here
         cmd = cmd.replace('""', "")
@@ -533,7 +1621,7 @@ class BatchDeobfuscator:
 
         self.traits["download"].append((cmd, {"src": url, "dst": dst}))
         if dst:
-            self.modified_filesystem[dst.lower()] = {"type": "download", "src": url}
+            self.modify_file(dst, {"type": "download", "src": url})
 
 
     def interpret_powershell(self, normalized_comm):
@@ -546,11 +1634,11 @@ class BatchDeobfuscator:
             args, unknown = self.powershell_invoke_webrequest_parser.parse_known_args(cmd[1:])
             if args.uri and args.outfile:
                 self.traits["download"].append((normalized_comm, {"src": args.uri, "dst": args.outfile}))
-                self.modified_filesystem[args.outfile.lower()] = {"type": "download", "src": args.uri}
+                self.modify_file(args.outfile, {"type": "download", "src": args.uri})
                 return
 
         for idx, part in enumerate(cmd):
-            if re.match(ENC_RE, part.encode()):
+            if ENC_RE.match(part.encode()):
                 if cmd[idx + 1][0] in ["'", '"']:
                     last_part = idx + 1
                     for i in range(last_part, len(cmd)):
@@ -572,7 +1660,7 @@ class BatchDeobfuscator:
                         return
                 break
             
-            elif re.match(PWR_CMD_RE, part.encode()):
+            elif PWR_CMD_RE.match(part.encode()):
                 if cmd[idx + 1][0] in ["'", '"']:
                     last_part = idx + 1
                     for i in range(last_part, len(cmd)):
@@ -586,7 +1674,7 @@ class BatchDeobfuscator:
                     ps1_cmd = " ".join(cmd[idx + 1 :]).encode()
                 break
             
-            elif re.match(PWR_FILE_RE, part.encode()):
+            elif PWR_FILE_RE.match(part.encode()):
                 # Found powershell execution of file, but not worth extracting the filename as a file
                 return
 
@@ -662,15 +1750,23 @@ class BatchDeobfuscator:
             # Won't follow the patttern "copy src dst", which we are currently looking at
             return
 
-        src = re.sub(r"\\+", r"\\", split_cmd[1])
-        dst = re.sub(r"\\+", r"\\", split_cmd[2])
+        src = BACKSLASHES_RE.sub(r"\\", split_cmd[1])
+        dst = BACKSLASHES_RE.sub(r"\\", split_cmd[2])
 
         if src.lower().startswith("c:\\windows\\system32") and not dst.lower().startswith("c:\\windows\\system32"):
             self.traits["windows-util-manipulation"].append((cmd, {"src": src, "dst": dst}))
-        self.modified_filesystem[dst.lower()] = {"type": "file", "src": src}
+        self.modify_file(dst, {"type": "file", "src": src})
 
 
     def interpret_command(self, normalized_comm):
+        # `call` and `start` hand over the rest of the command, which is interpreted in the same
+        # loop rather than recursively
+        while normalized_comm is not None:
+            normalized_comm = self.interpret_single_command(normalized_comm)
+
+
+    def interpret_single_command(self, normalized_comm):
+        # Returns the command to interpret next, if any
         if line_is_comment(normalized_comm):
             return
 
@@ -699,9 +1795,10 @@ class BatchDeobfuscator:
             normalized_comm = normalized_comm[1:]
 
         normalized_comm_lower = normalized_comm.lower()
-        command = normalized_comm_lower.split()[0]
-        if len(normalized_comm_lower.split("/")[0]) < len(command):
-            command = normalized_comm_lower.split("/")[0]
+        command = normalized_comm_lower.split(None, 1)[0]
+        before_slash = normalized_comm_lower.partition("/")[0]
+        if len(before_slash) < len(command):
+            command = before_slash
 
         # Some commands like `set` cannot be split by double quotes, but `cmd` and `powershell` can.
         if '""' in command:
@@ -717,83 +1814,114 @@ class BatchDeobfuscator:
             if self.modified_filesystem[command]["type"] == "file":
                 command = self.modified_filesystem[command]["src"]
 
-        if command == "call":
-            # Recursively interpret the command after "call"
-              # TODO: Not a perfect interpretation as the @ sign of the recursive command shouldn't be removed.
-              # This shouldn't work:
-              # call @set EXP=43
-              # But this should:
-              # call set EXP=43
-            self.interpret_command(normalized_comm[5:])
-            return
+        handler = self.command_handlers.get(canonical_command(command))
+        if handler is not None:
+            return handler(self, normalized_comm, command)
+
+
+    # Handlers of the commands, called with the normalized command and the command name as
+    # written (lowercase, possibly with a path and extension). They return the command to
+    # interpret next, if any.
+    def handle_call(self, normalized_comm, command):
+        # Interpret the command after "call"
+          # TODO: Not a perfect interpretation as the @ sign of the recursive command shouldn't be removed.
+          # This shouldn't work:
+          # call @set EXP=43
+          # But this should:
+          # call set EXP=43
+        return normalized_comm[5:]
+
+
+    def handle_start(self, normalized_comm, command):
+        match = START_RE.match(normalized_comm)
+        if match is not None and match.group("cmd") is not None:
+            return match.group("cmd")
+
+
+    def handle_cmd(self, normalized_comm, command):
+        match = CMD_RE.search(normalized_comm)
+        if match is not None and match.group("cmd") is not None:
+            command = match.group("cmd").strip('"')
+            self.exec_cmd.append(command)
+            if self.options.exitcodes and command.lower().startswith("exit"):
+                self.exit_code = command.lstrip("exit").strip()
+
+
+    def handle_set(self, normalized_comm, command):
+        # Interpret the "set" command to handle variable assignments
+        var_name, var_value = self.interpret_set(normalized_comm[3:])
+        var_name = var_name.lower()
+
+        if var_value == "":
+            self.unset_variable(var_name)
+        elif variable_is_dynamic(var_value) and self.options.exitcodes:
+            # Attempt to determine exit codes if the user specified it
+            dynamic_var = var_value[2:-1].lower()
+            if dynamic_var == "exitcodeascii" and self.exit_code.isdigit():
+                self.set_variable(var_name, chr(int(self.exit_code)))
+            elif dynamic_var == "exitcode":
+                self.set_variable(var_name, hex(int(self.exit_code)))
+            else:
+                self.set_variable(var_name, var_value)
+        else:
+            self.set_variable(var_name, var_value)
 
-        if command == "start":
-            # https://ss64.com/nt/start.html
-            start_re = (
-              r"start(.exe)?"
-              r"(\/min|\/max|\/wait|\/low|\/normal|\/abovenormal|\/belownormal|\/high|\/realtime|\/b|\/i|\/w|\s+)*"
-              # TODO: Add Node + Affinity options
-              # TODO: Add title + path keys
-              r"(?P<cmd>.*)"
-            )
-            match = re.match(start_re, normalized_comm, re.IGNORECASE)
-            if match is not None and match.group("cmd") is not None:
-                self.interpret_command(match.group("cmd"))
-            return
 
-        if command.endswith("cmd") or command.endswith("cmd.exe"):
-            # Handle "cmd" command with various options
-            cmd_command = r"cmd(.exe)?\s*((\/A|\/U|\/Q|\/D)\s+|((\/E|\/F|\/V):(ON|OFF))\s*)*(\/c|\/r)\s*(?P<cmd>.*)"
-            match = re.search(cmd_command, normalized_comm, re.IGNORECASE)
-            if match is not None and match.group("cmd") is not None:
-                command = match.group("cmd").strip('"')
-                self.exec_cmd.append(command)
-                if cli_args.exitcodes and command.lower().startswith("exit"):
-                    self.exit_code = command.lstrip("exit").strip()
-            return
+    def handle_curl(self, normalized_comm, command):
+        self.interpret_curl(normalized_comm)
 
-        if command == "set":
-            # Interpret the "set" command to handle variable assignments
-            var_name, var_value = self.interpret_set(normalized_comm[3:])
-            var_name = var_name.lower()
-
-            if var_value == "":
-                if var_name in self.variables:
-                    del self.variables[var_name]
-            elif variable_is_dynamic(var_value) and cli_args.exitcodes:
-                # Attempt to determine exit codes if the user specified it
-                dynamic_var = var_value[2:-1].lower()
-                if dynamic_var == "exitcodeascii" and self.exit_code.isdigit():
-                    self.variables[var_name] = chr(int(self.exit_code))
-                elif dynamic_var == "exitcode":
-                    self.variables[var_name] = hex(int(self.exit_code))
-                else:
-                    self.variables[var_name] = var_value
-            else:
-                self.variables[var_name] = var_value
-            return
 
-        if command.endswith("curl") or command.endswith("curl.exe"):
-            self.interpret_curl(normalized_comm)
+    def handle_powershell(self, normalized_comm, command):
+        # In case the target executable is a copy/lnk to powershell.exe, makes it simpler to parse the command
+        patch_cmd = normalized_comm.lstrip(command)
+        self.interpret_powershell(f"powershell.exe {patch_cmd}")
 
-        if command.endswith("powershell") or command.endswith("powershell.exe"):
-            # In case the target executable is a copy/lnk to powershell.exe, makes it simpler to parse the command
-            patch_cmd = normalized_comm.lstrip(command)
-            self.interpret_powershell(f"powershell.exe {patch_cmd}")
 
-        if command.endswith("mshta") or command.endswith("mshta.exe"):
-            self.interpret_mshta(normalized_comm)
+    def handle_mshta(self, normalized_comm, command):
+        self.interpret_mshta(normalized_comm)
 
-        if command.endswith("rundll32") or command.endswith("rundll32.exe"):
-            self.interpret_rundll32(normalized_comm)
 
-        if command == "copy":
-            self.interpret_copy(normalized_comm)
+    def handle_rundll32(self, normalized_comm, command):
+        self.interpret_rundll32(normalized_comm)
 
-        if command == "exit":
-            # Capture the exit code if provided, default to 0 otherwise
-            self.exit_code = normalized_comm.split()[1] if len(normalized_comm.split()) > 1 else "0"
-            return
+
+    def handle_copy(self, normalized_comm, command):
+        self.interpret_copy(normalized_comm)
+
+
+    def handle_exit(self, normalized_comm, command):
+        # Capture the exit code if provided, default to 0 otherwise
+        arguments = normalized_comm.split()
+        self.exit_code = arguments[1] if len(arguments) > 1 else "0"
+
+
+    # Looked up by the name of the command without its path and ".exe", see `canonical_command`.
+    # Programs can be run from any path, but the builtins of cmd can't.
+    command_handlers = {
+      "call": handle_call,
+      "start": handle_start,
+      "cmd": handle_cmd,
+      "set": handle_set,
+      "curl": handle_curl,
+      "powershell": handle_powershell,
+      "mshta": handle_mshta,
+      "rundll32": handle_rundll32,
+      "copy": handle_copy,
+      "exit": handle_exit,
+    }
+
+
+    def register_handler(self, name, handler):
+        """Handle the commands named `name` with `handler(deobfuscator, normalized_comm, command)`.
+
+        The handler is only registered on this deobfuscator and its children. To register it for
+        every deobfuscator, add it to the `command_handlers` of a subclass instead.
+        """
+        canonical_name = canonical_command(name.lower())
+        if canonical_name is None:
+            # Such as "set.exe": builtins of cmd are only run by their exact name
+            raise ValueError(f"Builtins of cmd can't be registered with a path or .exe: {name!r}")
+        self.command_handlers = {**self.command_handlers, canonical_name: handler}
 
 
     def valid_percent_tilde(self, argument):
@@ -853,6 +1981,61 @@ class BatchDeobfuscator:
 
 
     def normalize_command(self, command, rerun=False):
+        return self.run_nested(self.normalize_frame(command, rerun), "normalize_command")
+
+
+    def value_frame(self, value, rerun=False):
+        # Most values don't need to be normalized any further, which doesn't need a nested frame
+        if NORMALIZED_CHARS_RE.search(value) is not None or line_is_comment(value) or value == "@echo off":
+            return self.normalize_frame(value, rerun)
+        self.traits["var_used"].append((value, value, 0))
+        return None
+
+
+    def expand_reference_run(self, command, position, normalized_com, traits):
+        # Expands the run of references starting at `position` as the general path would, with
+        # the values gathered in one go instead of going through `get_value` one by one. Returns
+        # the end of the run, or None to leave anything irregular to the general path, and the
+        # position before which no other run needs to be looked for.
+        match = PLAIN_REFERENCE_RUN_RE.match(command, position)
+        try:
+            if match is not None:
+                names = match.group()[1:-1].lower().split("%%")
+                values = operator.itemgetter(*names)(self.variables)
+            else:
+                match = SLICE_REFERENCE_RUN_RE.match(command, position)
+                if match is None:
+                    return None, position + 1
+                value = self.variables[match.group("name").lower()]
+                if variable_is_dynamic(value):
+                    # Left as is by the general path, its characters aren't the ones of the value
+                    return None, match.end()
+                indices = [int(index) for index in SLICE_INDEX_RE.findall(match.group())]
+                values = operator.itemgetter(*indices)(value)
+        except (KeyError, IndexError):
+            # Undefined variable, or index past the end of the value
+            return None, match.end()
+
+        expanded = "".join(values)
+        # Values that need to be normalized any further, such as dynamic variables, see `value_frame`.
+        # The rest of the run isn't tried again, which would be quadratic in its length.
+        if NORMALIZED_CHARS_RE.search(expanded) is not None:
+            return None, match.end()
+        if max(map(len, values)) > 1 and any(line_is_comment(value) or value == "@echo off" for value in values):
+            return None, match.end()
+
+        if len(normalized_com) == 0 and values[0] == "":
+            traits["start_with_var"] = True
+        normalized_com.extend(expanded)
+        self.budget.check_command_length(normalized_com)
+        traits["var_used"] += len(values)
+        self.traits["var_used"].extend([(value, value, 0) for value in values])
+        return match.end(), match.end()
+
+
+    def normalize_frame(self, command, rerun=False):
+        # Generator run by `run_nested`: the values of the variables are normalized in nested
+        # frames, and are left as is when the nesting budget is exhausted
         if line_is_comment(command):
             return command
         
@@ -862,53 +2045,70 @@ class BatchDeobfuscator:
             return "REM @echo off"
 
         state = "init"
-        normalized_com = ""
+        # Characters are accumulated in a list so that appending and truncating the expanded
+        # variables stays linear in the size of the command
+        normalized_com = []
         stack = []
         traits = {"start_with_var": False, "var_used": 0}
-        for char in command:
+        characters = enumerate(command)
+        runs_checked = 0
+        for position, char in characters:
             if state == "init":
                 if char == '"':
                     # Quote is on
                     state = "quote_start"
-                    normalized_com += char
+                    normalized_com.append(char)
                 elif char == "," or char == ";":
                     # commas (",") are replaced by spaces, unless they are part of a string in doublequotes
                     # semicolons (";") are replaced by spaces, unless they are part of a string in doublequotes
                     # http://www.robvanderwoude.com/parameters.php
-                    normalized_com += " "
+                    normalized_com.append(" ")
                 elif char == "^":
                     # Next character must be escaped
                     stack.append(state)
                     state = "escape"
                 elif char == "%":
-                    # Normal variable start
-                    variable_start = len(normalized_com)
-                    normalized_com += char
-                    stack.append(state)
-                    state = "normal_var_start"
+                    end = None
+                    if not rerun and position >= runs_checked:
+                        end, runs_checked = self.expand_reference_run(command, position, normalized_com, traits)
+                    if end is not None:
+                        # Skips the rest of the run
+                        next(itertools.islice(characters, end - position - 2, None), None)
+                    else:
+                        # Normal variable start
+                        variable_start = len(normalized_com)
+                        normalized_com.append(char)
+                        stack.append(state)
+                        state = "normal_var_start"
                 elif char == "!":
                     # Delayed variable start, difference from `%` above is explained here:
                     # https://stackoverflow.com/a/14347131/6456163
                     variable_start = len(normalized_com)
-                    normalized_com += char
+                    normalized_com.append(char)
                     stack.append(state)
                     state = "delayed_var_start"
                 else:
-                    normalized_com += char
+                    normalized_com.append(char)
 
             elif state == "quote_start":
                 if char == '"':
                     state = "init"
-                    normalized_com += char
+                    normalized_com.append(char)
                 elif char == "%":
-                    variable_start = len(normalized_com)
-                    normalized_com += char
-                    stack.append("quote_start")
-                    # Track that we are inside a normal variable
-                    state = "normal_var_start"
+                    end = None
+                    if not rerun and position >= runs_checked:
+                        end, runs_checked = self.expand_reference_run(command, position, normalized_com, traits)
+                    if end is not None:
+                        next(itertools.islice(characters, end - position - 2, None), None)
+                    else:
+                        variable_start = len(normalized_com)
+                        normalized_com.append(char)
+                        stack.append("quote_start")
+                        # Track that we are inside a normal variable
+                        state = "normal_var_start"
                 elif char == "!":
                     variable_start = len(normalized_com)
-                    normalized_com += char
+                    normalized_com.append(char)
                     stack.append("quote_start")
                     # Track that we are inside a delayed execution variable
                     state = "delayed_var_start"
@@ -916,24 +2116,25 @@ class BatchDeobfuscator:
                     state = "escape"
                     stack.append("quote_start")
                 else:
-                    normalized_com += char
+                    normalized_com.append(char)
 
             elif state == "normal_var_start":
                 if char == "%" and normalized_com[-1] != char:
                     # The variable is closed
-                    normalized_com += char
+                    normalized_com.append(char)
                     if not rerun:
-                        value = self.get_value(normalized_com[variable_start:])
-                        normalized_com = normalized_com[:variable_start]
+                        value = self.get_value("".join(normalized_com[variable_start:]))
+                        del normalized_com[variable_start:]
                         # Prevents "nested variable definition" for dynamic vars
-                        normalized_com += self.normalize_command(value, True)
+                        normalized_com.extend((yield self.value_frame(value, True), value))
+                        self.budget.check_command_length(normalized_com)
                     if len(normalized_com) == 0:
                         traits["start_with_var"] = True
                     traits["var_used"] += 1
                     state = stack.pop()
                 elif char == "%":
                     # Two `%` chars in a row
-                    normalized_com += char
+                    normalized_com.append(char)
                     state = stack.pop()
                 elif char == "=" and normalized_com[-1] == "%":
                     # `%=` is used for undocumented dynamic variables, which cannot be used with `set`
@@ -941,69 +2142,71 @@ class BatchDeobfuscator:
                     # `%=exitcodeAscii%` in conjunction with `set /a` to get the exit code of the
                     # last command, usually ran by `cmd /c` for further obfuscation.
                     # More info: https://ss64.com/nt/syntax-variables.html
-                    normalized_com += char
+                    normalized_com.append(char)
                     state = "inside_dynamic_var"
                 elif char == "^":
                     # Don't escape in vars
-                    normalized_com += char
+                    normalized_com.append(char)
                 elif char == "*" and len(normalized_com) == variable_start + 1:
                     # `%*` is a special variable that expands to all the parameters passed to the script,
                     # which is usually used to forward the parameters to another script.
 
                     # Assume no parameters were passed
-                    normalized_com = normalized_com[:variable_start]
+                    del normalized_com[variable_start:]
                     state = stack.pop()
-                elif char.isdigit() and self.valid_percent_tilde(normalized_com[variable_start:]):
+                elif char.isdigit() and self.valid_percent_tilde("".join(normalized_com[variable_start:])):
                     # TODO: %~$PATH:0 is not handled.
                     if char == "0":
-                        value = self.percent_tilde(normalized_com[variable_start:])
+                        value = self.percent_tilde("".join(normalized_com[variable_start:]))
                     else:
                         # Assume no parameters were passed
                         value = ""
-                    normalized_com = normalized_com[:variable_start]
-                    normalized_com += value
+                    del normalized_com[variable_start:]
+                    normalized_com.extend(value)
                     state = stack.pop()
                 else:
-                    normalized_com += char
+                    normalized_com.append(char)
 
             elif state == "delayed_var_start":
                 if char == "!" and normalized_com[-1] != char:
-                    normalized_com += char
-                    value = self.get_value(normalized_com[variable_start:])
-                    normalized_com = normalized_com[:variable_start]
+                    normalized_com.append(char)
+                    value = self.get_value("".join(normalized_com[variable_start:]))
+                    del normalized_com[variable_start:]
                     if len(normalized_com) == 0:
                         traits["start_with_var"] = True
-                    normalized_com += self.normalize_command(value)
+                    normalized_com.extend((yield self.value_frame(value), value))
+                    self.budget.check_command_length(normalized_com)
                     traits["var_used"] += 1
                     state = stack.pop()
                 elif char == "!":
-                    normalized_com += char
+                    normalized_com.append(char)
                 elif char == "^":
                     state = "escape"
                     stack.append("delayed_var_start")
                 else:
-                    normalized_com += char
+                    normalized_com.append(char)
             
             elif state == "inside_dynamic_var":
                 if char == "%":
                     # The dynamic variable is closed
-                    normalized_com += char
+                    normalized_com.append(char)
                     state = stack.pop()
                 else:
-                    normalized_com += char
+                    normalized_com.append(char)
 
             elif state == "escape":
                 if char in QUOTED_CHARS:
-                    normalized_com += "^"
-                normalized_com += char
+                    normalized_com.append("^")
+                normalized_com.append(char)
                 state = stack.pop()
                 if char == "%":
                     if state == "normal_var_start":
-                        value = self.get_value(normalized_com[variable_start:])
-                        normalized_com = normalized_com[:variable_start]
+                        value = self.get_value("".join(normalized_com[variable_start:]))
+                        del normalized_com[variable_start:]
                         if len(normalized_com) == 0:
                             traits["start_with_var"] = True
-                        normalized_com += self.normalize_command(value)
+                        normalized_com.extend((yield self.value_frame(value), value))
+                        self.budget.check_command_length(normalized_com)
                         traits["var_used"] += 1
                         state = stack.pop()
                     else:
@@ -1012,11 +2215,12 @@ class BatchDeobfuscator:
                         state = "normal_var_start"
                 elif char == "!":
                     if state == "delayed_var_start":
-                        value = self.get_value(normalized_com[variable_start:])
-                        normalized_com = normalized_com[:variable_start]
+                        value = self.get_value("".join(normalized_com[variable_start:]))
+                        del normalized_com[variable_start:]
                         if len(normalized_com) == 0:
                             traits["start_with_var"] = True
-                        normalized_com += self.normalize_command(value)
+                        normalized_com.extend((yield self.value_frame(value), value))
+                        self.budget.check_command_length(normalized_com)
                         traits["var_used"] += 1
                         state = stack.pop()
                     else:
@@ -1025,10 +2229,11 @@ class BatchDeobfuscator:
                         state = "delayed_var_start"
 
         if state in ["normal_var_start", "delayed_var_start"]:
-            normalized_com = normalized_com[:variable_start] + normalized_com[variable_start + 1 :]
+            del normalized_com[variable_start]
         elif state == "escape":
-            normalized_com += "^"
+            normalized_com.append("^")
 
+        normalized_com = "".join(normalized_com)
         if traits["start_with_var"]:
             self.traits["start_with_var"].append((command, normalized_com))
         self.traits["var_used"].append((command, normalized_com, traits["var_used"]))
@@ -1036,142 +2241,266 @@ class BatchDeobfuscator:
         return normalized_com
 
 
-    def analyze_logical_line(self, logical_line, working_directory, f, extracted_files):
-        commands = self.get_commands(logical_line)
+    def split_grouped_command(self, normalized_comm):
+        # Returns the commands grouped in a normalized command, or None if there is only one.
+        # Only separators or an if/for statement can produce more than one command, which is
+        # checked in C beforehand so most commands are never tokenized a second time.
+        if "&" not in normalized_comm and "|" not in normalized_comm:
+            if not normalized_comm.lstrip(" ").lower().startswith(("if ", "for ")):
+                return None
+        commands = list(self.get_commands(normalized_comm))
+        return commands if len(commands) > 1 else None
+
+
+    def analyze_logical_line(self, logical_line, artifacts, f):
+        self.analyze_commands(self.get_commands(logical_line), artifacts, f)
+
+
+    def analyze_commands(self, commands, artifacts, f):
+        self.run_nested(self.analyze_frame(commands, artifacts, f), "analyze_commands")
+
+
+    def analyze_frame(self, commands, artifacts, f):
+        # Generator run by `run_nested`, returns False instead when skipped by the nesting budget
         for command in commands:
             normalized_comm = self.normalize_command(command)
-            if len(list(self.get_commands(normalized_comm))) > 1:
+            grouped_commands = self.split_grouped_command(normalized_comm)
+            if grouped_commands is not None:
                 self.traits["command-grouping"].append({"Command": command, "Normalized": normalized_comm})
-                self.analyze_logical_line(normalized_comm, working_directory, f, extracted_files)
+                yield self.analyze_frame(grouped_commands, artifacts, f), False
             else:
+                self.budget.spend_command(normalized_comm)
                 self.interpret_command(normalized_comm)
                 f.write(normalized_comm)
                 f.write("\r\n")
-                for lolbas in RARE_LOLBAS:
-                    if lolbas in normalized_comm:
-                        self.traits["LOLBAS"].append({"LOLBAS": lolbas, "Command": normalized_comm})
-                        
+                for category, indicator in self.indicators.find(normalized_comm):
+                    self.traits[category].append({category: indicator, "Command": normalized_comm})
+
                 if len(self.exec_cmd) > 0:
                     for child_cmd in self.exec_cmd:
-                        child_deobfuscator = copy.deepcopy(self)
-                        child_deobfuscator.exec_cmd.clear()
-                        _, child_path = tempfile.mkstemp(suffix=".bat", prefix="child_", dir=working_directory)
-                        with open(child_path, "w") as child_f:
-                            child_deobfuscator.analyze_logical_line(
-                              child_cmd, working_directory, child_f, extracted_files
-                            )
-                        with open(child_path, "rb") as cmd_f:
-                            sha256hash = hashlib.sha256(cmd_f.read()).hexdigest()
-                        bat_filename = f"{sha256hash[0:10]}.bat"
-                        shutil.move(child_path, os.path.join(working_directory, bat_filename))
-                        extracted_files["batch"].append((bat_filename, sha256hash))
+                        child_key = self.child_key(child_cmd)
+                        if child_key is not None and child_key in artifacts.analyzed_children:
+                            artifacts.hits["batch"] += 1
+                            continue
+                        child_deobfuscator = self.spawn_child()
+                        child_f = HashingWriter()
+                        child_commands = child_deobfuscator.get_commands(child_cmd)
+                        if not (yield child_deobfuscator.analyze_frame(child_commands, artifacts, child_f), False):
+                            continue
+                        sha256hash = child_f.hexdigest()
+                        artifacts.add("batch", f"{sha256hash[0:10]}.bat", child_f.getvalue(), sha256hash)
+                        if child_key is not None:
+                            artifacts.analyzed_children.add(child_key)
                     self.exec_cmd.clear()
 
                 if len(self.exec_ps1) > 0:
                     for child_ps1 in self.exec_ps1:
                         sha256hash = hashlib.sha256(child_ps1).hexdigest()
-                        if any(
-                          extracted_file_hash == sha256hash
-                          for _, extracted_file_hash in extracted_files.get("powershell", [])
-                        ):
-                            continue
-                        powershell_filename = f"{sha256hash[0:10]}.ps1"
-                        powershell_file_path = os.path.join(working_directory, powershell_filename)
-                        with open(powershell_file_path, "wb") as ps1_f:
-                            ps1_f.write(child_ps1)
-                        extracted_files["powershell"].append((powershell_filename, sha256hash))
+                        artifacts.add("powershell", f"{sha256hash[0:10]}.ps1", child_ps1, sha256hash)
                     self.exec_ps1.clear()
+        return True
 
 
-    def analyze(self, file_path, working_directory):
-        extracted_files = defaultdict(list)
-        self.file_path = file_path
+    def analyze_stream(self, stream, working_directory=None):
+        """Analyze a binary stream without needing any temporary file.
 
-        file_name = "deobfuscated_bat.bat"
-        temp_path = os.path.join(working_directory, file_name)
-        with open(temp_path, "w") as f:
-            for logical_line in self.read_logical_line(file_path):
-                self.analyze_logical_line(logical_line, working_directory, f, extracted_files)
+        Returns the name of the deobfuscated script, the extracted files by type, and the content of
+        every artifact (including the deobfuscated script) by name. When a working directory is
+        given, the artifacts are also written there.
+        """
+        artifacts = ArtifactStore(working_directory)
+        bat_filename = self._analyze(stream, artifacts)
+        return bat_filename, artifacts.extracted_files, artifacts.contents
 
-        # Figure out if we're dealing with a Complex One-Liner
-        # Ignore empty lines to determine if it is a One-Liner
-        self.traits["one-liner"] = False
-        with open(file_path, "r", encoding="utf-8", errors="ignore") as f:
-            firstline = False
-            for line in f:
-                if line.strip():
-                    if not firstline:
-                        self.traits["one-liner"] = True
-                        firstline = True
-                    else:
-                        self.traits["one-liner"] = False
-                        break
 
-        with open(temp_path, "rb") as f:
-            deobfuscated_data = f.read()
-            if self.traits["one-liner"]:
-                resulting_line_count = deobfuscated_data.count(b"\n")
-                if resulting_line_count >= self.complex_one_liner_threshold:
-                    self.traits["complex-one-liner"] = resulting_line_count
-            sha256hash = hashlib.sha256(deobfuscated_data).hexdigest()
-            bat_filename = f"{sha256hash[0:10]}_deobfuscated.bat"
-            shutil.move(temp_path, os.path.join(working_directory, bat_filename))
+    def analyze_bytes(self, data, working_directory=None):
+        return self.analyze_stream(io.BytesIO(data), working_directory)
+
 
+    def analyze(self, file_path, working_directory):
+        self.file_path = file_path
+        artifacts = ArtifactStore(working_directory, keep_contents=False)
+        with open(file_path, "rb") as stream:
+            bat_filename = self._analyze(stream, artifacts)
         self.file_path = None
-        return bat_filename, extracted_files
+        return bat_filename, artifacts.extracted_files
+
+
+    def _analyze(self, stream, artifacts):
+        with map_buffer(stream) as buffer:
+            key = self.cache_key("analyze", buffer)
+            entry = self.cache.get(key) if key is not None else None
+            if entry is not None:
+                self.traits.update(entry.traits)
+                for file_type, files in entry.extracted_files.items():
+                    for filename, sha256hash in files:
+                        artifacts.add(file_type, filename, entry.contents[filename], sha256hash)
+                artifacts.add(None, entry.output, entry.contents[entry.output], None)
+                return entry.output
+
+            # The contents are needed for the cache even if the caller doesn't keep them
+            keep_contents = artifacts.keep_contents
+            artifacts.keep_contents = keep_contents or key is not None
+            bat_filename = self.analyze_buffer(buffer, artifacts)
+            extracted_files = {file_type: list(files) for file_type, files in artifacts.extracted_files.items()}
+            self.cache_result(key, CacheEntry(bat_filename, dict(self.traits), extracted_files, artifacts.contents))
+            if not keep_contents:
+                artifacts.contents = {}
+            artifacts.keep_contents = keep_contents
+            return bat_filename
+
+
+    def analyze_buffer(self, buffer, artifacts):
+        # Figure out if we're dealing with a Complex One-Liner while reading the input.
+        # Ignore empty lines to determine if it is a One-Liner
+        non_empty_lines = 0
 
+        def count_lines(lines):
+            nonlocal non_empty_lines
+            for line in lines:
+                if line.strip():
+                    non_empty_lines += 1
+                yield line
 
-def interpret_logical_line(deobfuscator, logical_line, tab="", child=False):
+        f = HashingWriter()
+        self.budget.start()
+        if self.profile_stats is not None:
+            artifacts.add = profiled(self.profile_stats, "artifact_writes", artifacts.add)
+        try:
+            for logical_line in self.join_logical_lines(count_lines(self.decode_lines(buffer))):
+                self.analyze_logical_line(logical_line, artifacts, f)
+        except BudgetExceeded as e:
+            # Keep what was deobfuscated so far
+            self.traits["budget-exceeded"] = e.limit
+
+        self.traits["one-liner"] = non_empty_lines == 1
+        if self.traits["one-liner"]:
+            resulting_line_count = f.line_count
+            if resulting_line_count >= self.complex_one_liner_threshold:
+                self.traits["complex-one-liner"] = resulting_line_count
+        if artifacts.hits:
+            self.traits["duplicate-artifacts"] = dict(artifacts.hits)
+        sha256hash = f.hexdigest()
+        bat_filename = f"{sha256hash[0:10]}_deobfuscated.bat"
+        artifacts.add(None, bat_filename, f.getvalue(), sha256hash)
+        return bat_filename
+
+
+def interpret_logical_line_iter(deobfuscator, logical_line, tab="", child=False):
+    # Yields the deobfuscated lines one by one, so they can be consumed before the whole logical
+    # line (and its children) has been interpreted. Children are frames on an explicit stack
+    # rather than nested generators, so deeply nested `cmd /c` can't exhaust the stack.
+    frames = [interpret_frame(deobfuscator, logical_line, tab, child)]
+    while frames:
+        item = next(frames[-1], None)
+        if item is None:
+            frames.pop()
+        elif isinstance(item, str):
+            yield item
+        elif len(frames) >= deobfuscator.max_depth:
+            item.close()
+            deobfuscator.nesting_limit_reached("interpret_logical_line", True)
+        else:
+            frames.append(item)
+
+
+def interpret_frame(deobfuscator, logical_line, tab, child):
+    # Yields the deobfuscated lines, and the frames of the children in between
     commands = deobfuscator.get_commands(logical_line)
     for command in commands:
         normalized_comm = deobfuscator.normalize_command(command)
+        deobfuscator.budget.spend_command(normalized_comm)
         deobfuscator.interpret_command(normalized_comm)
-        if not child or cli_args.verbose:
-            if not line_is_comment(normalized_comm) or cli_args.verbose:
-                print(tab + normalized_comm)
+        verbose = deobfuscator.options.verbose
+        if not child or verbose:
+            if not line_is_comment(normalized_comm) or verbose:
+                yield tab + normalized_comm
         if len(deobfuscator.exec_cmd) > 0:
-            if cli_args.verbose:
+            if verbose:
                 # Gives the user context that a child command is running, but doesn't
                 # actually execute the code again, because that is being handled
                 # by the inline `cmd /c` command. The `goto` serves as a multi-line
                 # comment, since they aren't natively supported in batch.
-                print(tab + "# [RUNNING IN CHILD CMD]")
-                print(tab + "goto comment")
+                yield tab + "# [RUNNING IN CHILD CMD]"
+                yield tab + "goto comment"
             for child_cmd in deobfuscator.exec_cmd:
-                child_deobfuscator = copy.deepcopy(deobfuscator)
-                child_deobfuscator.exec_cmd.clear()
-                interpret_logical_line(child_deobfuscator, child_cmd, tab=tab + "\t", child=True)
+                child_deobfuscator = deobfuscator.spawn_child()
+                yield interpret_frame(child_deobfuscator, child_cmd, tab + "\t", True)
             deobfuscator.exec_cmd.clear()
-            if cli_args.verbose:
-                print(tab + ":comment")
-                print(tab + "# [END OF CHILD CMD]")
+            if verbose:
+                yield tab + ":comment"
+                yield tab + "# [END OF CHILD CMD]"
+
+
+def interpret_logical_line_lines(deobfuscator, logical_line, tab="", child=False):
+    for line in interpret_logical_line_iter(deobfuscator, logical_line, tab, child):
+        if deobfuscator.options.verbose:
+            yield line
+        else:
+            # Remove empty lines if not verbose
+            yield from filter(bool, line.splitlines())
+
+
+# Each call of these two is a sample of its own for the budget, so the deadline counts from the
+# call rather than from the creation of the deobfuscator. Going over the budget stops the call
+# with what was deobfuscated so far, as for a file.
+def interpret_logical_line(deobfuscator, logical_line, tab="", child=False):
+    deobfuscator.budget.start()
+    try:
+        for line in interpret_logical_line_iter(deobfuscator, logical_line, tab, child):
+            print(line)
+    except BudgetExceeded as e:
+        deobfuscator.traits["budget-exceeded"] = e.limit
 
 
 def interpret_logical_line_str(deobfuscator, logical_line, tab="", child=False):
-    str = ""
-    commands = deobfuscator.get_commands(logical_line)
-    for command in commands:
-        normalized_comm = deobfuscator.normalize_command(command)
-        deobfuscator.interpret_command(normalized_comm)
-        if not child or cli_args.verbose:
-            if not line_is_comment(normalized_comm) or cli_args.verbose:
-                str += tab + normalized_comm
-        if len(deobfuscator.exec_cmd) > 0:
-            if cli_args.verbose:
-                str += "\n" + tab + "# [RUNNING IN CHILD CMD]" + "\n"
-                str += tab + "goto comment" + "\n"
-            for child_cmd in deobfuscator.exec_cmd:
-                child_deobfuscator = copy.deepcopy(deobfuscator)
-                child_deobfuscator.exec_cmd.clear()
-                str += interpret_logical_line_str(child_deobfuscator, child_cmd, tab=tab + "\t", child=True) + "\n"
-            deobfuscator.exec_cmd.clear()
-            if cli_args.verbose:
-                str += tab + ":comment" + "\n"
-                str += tab + "# [END OF CHILD CMD]"
-    # Remove empty lines if not verbose
-    if not cli_args.verbose:
-        str = "\n".join(filter(bool, str.splitlines()))
-    return str
+    deobfuscator.budget.start()
+    lines = []
+    try:
+        for line in interpret_logical_line_lines(deobfuscator, logical_line, tab, child):
+            lines.append(line)
+    except BudgetExceeded as e:
+        deobfuscator.traits["budget-exceeded"] = e.limit
+    return "\n".join(lines)
+
+
+def write_bat_file(deobfuscator, fpath, output_file):
+    # Streams the deobfuscated script to `output_file` as it is interpreted, with one line of
+    # output per logical line of the original script, like `interpret_logical_line_str`
+    deobfuscator.budget.start()
+    for logical_line in deobfuscator.read_logical_line(fpath):
+        separator = ""
+        try:
+            for line in interpret_logical_line_lines(deobfuscator, logical_line):
+                output_file.write(separator)
+                output_file.write(line)
+                separator = "\n"
+        except BudgetExceeded as e:
+            # Everything deobfuscated so far has already been written
+            deobfuscator.traits["budget-exceeded"] = e.limit
+            output_file.write(separator)
+            return
+        output_file.write("\n")
+
+
+def iter_deobfuscated_lines(deobfuscator, logical_lines):
+    # Yields the deobfuscated text of each logical line, until the budget is exceeded
+    deobfuscator.budget.start()
+    for logical_line in logical_lines:
+        lines = []
+        try:
+            for line in interpret_logical_line_lines(deobfuscator, logical_line):
+                lines.append(line)
+        except BudgetExceeded as e:
+            # Keep what was deobfuscated so far
+            deobfuscator.traits["budget-exceeded"] = e.limit
+            yield "\n".join(lines)
+            return
+        except Exception as e:
+            print(e)
+            pass
+        else:
+            yield "\n".join(lines)
 
 
 # NOTE: This function is not used anywhere in this file, but is exported to add the
@@ -1181,12 +2510,12 @@ def handle_bat_file(deobfuscator, fpath):
     strs = []
     if os.path.isfile(fpath):
         try:
-            for logical_line in deobfuscator.read_logical_line(fpath):
-                try:
-                    strs.append(interpret_logical_line_str(deobfuscator, logical_line))
-                except Exception as e:
-                    print(e)
-                    pass
+            if deobfuscator.cache is not None:
+                # The content of the file is needed anyway to look it up
+                with open(fpath, "rb") as input_file, map_buffer(input_file) as buffer:
+                    return handle_bat_bytes(deobfuscator, buffer)
+            for text in iter_deobfuscated_lines(deobfuscator, deobfuscator.read_logical_line(fpath)):
+                strs.append(text)
         except Exception as e:
             print(e)
             pass
@@ -1196,6 +2525,110 @@ def handle_bat_file(deobfuscator, fpath):
         return ""
 
 
+def handle_bat_bytes(deobfuscator, data):
+    # Same as `handle_bat_file`, for a script that is already in memory
+    key = deobfuscator.cache_key("text", data)
+    entry = deobfuscator.cache.get(key) if key is not None else None
+    if entry is not None:
+        deobfuscator.traits.update(entry.traits)
+        return entry.output
+    logical_lines = deobfuscator.join_logical_lines(deobfuscator.decode_lines(data))
+    output = "\n".join(iter_deobfuscated_lines(deobfuscator, logical_lines))
+    deobfuscator.cache_result(key, CacheEntry(output, dict(deobfuscator.traits), {}, {}))
+    return output
+
+
+class AnalysisTimeout(BaseException):
+    # Derived from BaseException so that it isn't swallowed by the per-line error handling
+    # of `handle_bat_file`, in the same way a KeyboardInterrupt wouldn't be
+    pass
+
+
+def _raise_analysis_timeout(signum, frame):
+    raise AnalysisTimeout()
+
+
+@contextlib.contextmanager
+def analysis_alarm(timeout):
+    # Backstop for a deobfuscator that doesn't get to check its deadline: SIGALRM raises an
+    # AnalysisTimeout a bit after it, on POSIX systems and from the main thread only
+    use_alarm = (
+      timeout is not None and hasattr(signal, "setitimer") and threading.current_thread() is threading.main_thread()
+    )
+    if not use_alarm:
+        yield
+        return
+    previous_handler = signal.signal(signal.SIGALRM, _raise_analysis_timeout)
+    signal.setitimer(signal.ITIMER_REAL, timeout * 2 + 1)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous_handler)
+
+
+def deobfuscate_file(fpath, timeout=None, options=None, cache_path=None, cache_size=DEFAULT_CACHE_SIZE):
+    """Deobfuscate a single file with a fresh BatchDeobfuscator, as done by the corpus workers.
+
+    When the timeout (in seconds) is reached, the output deobfuscated so far is returned with a
+    "timeout" status. In case the deobfuscator doesn't get to check its deadline, SIGALRM also
+    interrupts it a bit later, without any output, on POSIX systems and from the main thread.
+    With a cache path, the results are looked up and stored in the ResultCache of the process.
+    """
+    result = {"path": fpath, "status": "ok", "output": "", "error": None, "elapsed": 0.0}
+    if not os.path.isfile(fpath):
+        result["status"] = "error"
+        result["error"] = "File not found"
+        return result
+
+    start = time.perf_counter()
+    try:
+        with analysis_alarm(timeout):
+            cache = open_cache(cache_path, cache_size) if cache_path is not None else None
+            deobfuscator = BatchDeobfuscator(timeout=timeout, options=options, cache=cache)
+            result["output"] = handle_bat_file(deobfuscator, fpath)
+        if deobfuscator.traits.get("budget-exceeded") == "timeout":
+            result["status"] = "timeout"
+    except AnalysisTimeout:
+        result["status"] = "timeout"
+    except Exception as e:
+        result["status"] = "error"
+        result["error"] = repr(e)
+    result["elapsed"] = time.perf_counter() - start
+    return result
+
+
+def iter_corpus(directory):
+    for root, _, files in os.walk(directory):
+        for name in sorted(files):
+            yield os.path.join(root, name)
+
+
+def deobfuscate_many(paths, workers=None, timeout=None, options=None, cache_path=None, cache_size=DEFAULT_CACHE_SIZE):
+    """Deobfuscate many files across a process pool, yielding results as they complete.
+
+    Each result is the dictionary returned by `deobfuscate_file`. Results are not yielded in the
+    order of `paths`. Only a few files per worker are queued at once, so `paths` can be a lazy
+    iterable over a very large corpus.
+    """
+    workers = workers or os.cpu_count() or 1
+    # Workers may be spawned rather than forked, so the options are sent along with every file
+    options = vars(make_options(options))
+    paths = iter(paths)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        while True:
+            for fpath in paths:
+                pending.add(executor.submit(deobfuscate_file, fpath, timeout, options, cache_path, cache_size))
+                if len(pending) >= workers * 2:
+                    break
+            if not pending:
+                return
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
 # NOTE: This is the portion that is used when the script is run directly,
 # and is not used when the script is imported as a library.
 if __name__ == "__main__":
@@ -1205,22 +2638,51 @@ if __name__ == "__main__":
     parser.add_argument("-v", "--verbose", action="store_true", help="Whether to include additional information in the output, such as child commands and comments")
     parser.add_argument("-m", "--math", action="store_true", help="Whether to attempt to execute mathematical operations in the batch file")
     parser.add_argument("-e", "--exitcodes", action="store_true", help="Whether to attempt to store command exit codes and replace `%%=exitcodeAscii%%` with the appropriate value")
+    parser.add_argument("-c", "--corpus", type=str, help="The path of a directory of obfuscated batch files to deobfuscate in parallel, --output is then used as a directory")
+    parser.add_argument("-w", "--workers", type=int, help="The number of worker processes used with --corpus (default: number of CPUs)")
+    parser.add_argument("-t", "--timeout", type=float, help="The maximum number of seconds spent on each file of a --corpus")
+    parser.add_argument("-p", "--profile", action="store_true", help="Whether to print the calls and cumulative time of each stage to stderr, as JSON")
+    parser.add_argument("--cache", type=str, help="The path of a SQLite database caching the results across runs, by the content of the files")
+    parser.add_argument("--cache-size", type=float, default=DEFAULT_CACHE_SIZE / 1024 / 1024, help="The size past which the least recently used results are evicted from --cache, in MiB")
     cli_args, _ = parser.parse_known_args()
+    cache_size = int(cli_args.cache_size * 1024 * 1024)
 
-    deobfuscator = BatchDeobfuscator()
+    cache = ResultCache(cli_args.cache, cache_size) if cli_args.cache is not None and cli_args.corpus is None else None
+    deobfuscator = BatchDeobfuscator(profile=cli_args.profile, options=cli_args, cache=cache)
 
-    if cli_args.file is not None:
-        file_path = cli_args.file
-        output = ""
-        for logical_line in deobfuscator.read_logical_line(cli_args.file):
+    if cli_args.corpus is not None:
+        results = deobfuscate_many(
+          iter_corpus(cli_args.corpus), cli_args.workers, cli_args.timeout, cli_args, cli_args.cache, cache_size
+        )
+        for result in results:
+            if result["status"] != "ok":
+                print(f"{result['path']}: {result['status']} {result['error'] or ''}".rstrip(), file=sys.stderr)
             if cli_args.output is not None:
-                output += interpret_logical_line_str(deobfuscator, logical_line) + "\n"
+                output_path = os.path.join(cli_args.output, os.path.relpath(result["path"], cli_args.corpus))
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with open(output_path, "w") as f:
+                    f.write(result["output"] + "\n" if result["output"] else "")
             else:
-                interpret_logical_line(deobfuscator, logical_line)
+                print(f"REM {result['path']}")
+                print(result["output"])
 
-        if cli_args.output is not None:
+    elif cli_args.file is not None:
+        if cache is not None:
+            # Cached results are whole scripts, written like with --output
+            output = handle_bat_file(deobfuscator, cli_args.file)
+            if cli_args.output is not None:
+                with open(cli_args.output, "w") as f:
+                    f.write(output + "\n" if output else "")
+            else:
+                print(output)
+        elif cli_args.output is not None:
             with open(cli_args.output, "w") as f:
-                f.write(output)
+                write_bat_file(deobfuscator, cli_args.file, f)
+        else:
+            for logical_line in deobfuscator.read_logical_line(cli_args.file):
+                interpret_logical_line(deobfuscator, logical_line)
+        if cli_args.profile:
+            print(json.dumps(deobfuscator.profile_stats, indent=2), file=sys.stderr)
 
     else:
         print("Enter an obfuscated batch command:")
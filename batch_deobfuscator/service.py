@@ -0,0 +1,270 @@
+"""Asyncio front-end to deobfuscate scripts on demand, backed by a bounded pool of worker processes.
+
+    from batch_deobfuscator.service import deobfuscate
+    result = await deobfuscate(data, {"math": True})
+
+Requests wait for a free worker in a bounded queue, and are turned away with an "overloaded"
+status once it is full. Each request has a timeout, which includes the time spent queueing.
+
+Run as a local HTTP server, on a TCP port or a Unix socket:
+    python -m batch_deobfuscator.service --port 8080
+    curl --data-binary @obfuscated_file.bat "http://127.0.0.1:8080/deobfuscate?math=1&exitcodes=1"
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import multiprocessing
+import os
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from urllib.parse import parse_qsl, urlsplit
+
+from .batch_interpreter import AnalysisTimeout, BatchDeobfuscator, TraitSummary, analysis_alarm, handle_bat_bytes
+
+# Status is "ok", "timeout" (the output is then partial), "overloaded" or "error"
+Result = namedtuple("Result", ["status", "output", "traits", "error", "elapsed"])
+
+# Time given to a worker to return after its own deadline, before the request is given up on
+TIMEOUT_GRACE = 1.0
+# Default limits of a single script, so that expansions such as `set a=%a%%a%` run into the budget
+# rather than exhausting the memory of a worker
+MAX_COMMAND_LENGTH = 4 * 1024 * 1024
+MAX_OUTPUT_BYTES = 64 * 1024 * 1024
+HTTP_STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 413: "Payload Too Large", 503: "Service Unavailable"}
+
+
+def deobfuscate_bytes(data, options=None, timeout=None, max_command_length=MAX_COMMAND_LENGTH, max_output_bytes=MAX_OUTPUT_BYTES):
+    # Runs in the worker processes
+    start = time.perf_counter()
+    deobfuscator = BatchDeobfuscator(
+      options=options, timeout=timeout, max_command_length=max_command_length, max_output_bytes=max_output_bytes
+    )
+    try:
+        with analysis_alarm(timeout):
+            output = handle_bat_bytes(deobfuscator, data)
+    except AnalysisTimeout:
+        return Result("timeout", "", dict(deobfuscator.traits), "Interrupted", time.perf_counter() - start)
+    except Exception as e:
+        return Result("error", "", {}, repr(e), time.perf_counter() - start)
+    status = "timeout" if deobfuscator.traits.get("budget-exceeded") == "timeout" else "ok"
+    return Result(status, output, dict(deobfuscator.traits), None, time.perf_counter() - start)
+
+
+class DeobfuscationService:
+    def __init__(
+      self,
+      workers=None,
+      max_queue=64,
+      timeout=30.0,
+      max_command_length=MAX_COMMAND_LENGTH,
+      max_output_bytes=MAX_OUTPUT_BYTES,
+    ):
+        self.workers = workers or os.cpu_count() or 1
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self.limits = (max_command_length, max_output_bytes)
+        self.executor = self.new_executor()
+        # A slot is held until the worker is done, even after its request was given up on, so that
+        # no job waits in the unbounded queue of the executor
+        self.slots = asyncio.Semaphore(self.workers)
+        # Requests either running or waiting for a worker
+        self.pending = 0
+
+
+    def new_executor(self):
+        # Forked workers would inherit the sockets of the connections open at the time, and keep
+        # them open after the server closes them
+        return ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+    def release_slot(self, loop):
+        # Called by the executor when a job is done, from its own thread
+        with contextlib.suppress(RuntimeError):
+            # The loop was closed in the meantime
+            loop.call_soon_threadsafe(self.slots.release)
+
+
+    async def deobfuscate(self, data, options=None, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        if self.pending >= self.workers + self.max_queue:
+            # Backpressure: turn the request away rather than letting the queue grow
+            return Result("overloaded", "", {}, "Too many pending requests", 0.0)
+
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        self.pending += 1
+        try:
+            try:
+                await asyncio.wait_for(self.slots.acquire(), timeout)
+            except asyncio.TimeoutError:
+                return Result("timeout", "", {}, "Timed out waiting for a worker", loop.time() - start)
+            executor = self.executor
+            remaining = max(timeout - (loop.time() - start), 0.0)
+            try:
+                future = executor.submit(deobfuscate_bytes, data, options, remaining, *self.limits)
+            except BrokenProcessPool:
+                self.slots.release()
+                self.replace_executor(executor)
+                return Result("error", "", {}, "A worker died", loop.time() - start)
+            future.add_done_callback(lambda _: self.release_slot(loop))
+            try:
+                # The worker stops by itself at its deadline, with the partial output. In case it
+                # doesn't get to check it, the request is given up on a bit later.
+                return await asyncio.wait_for(asyncio.wrap_future(future), remaining + TIMEOUT_GRACE)
+            except asyncio.TimeoutError:
+                return Result("timeout", "", {}, "The worker didn't return in time", loop.time() - start)
+            except BrokenProcessPool:
+                self.replace_executor(executor)
+                return Result("error", "", {}, "A worker died", loop.time() - start)
+        finally:
+            self.pending -= 1
+
+
+    def replace_executor(self, executor):
+        # A dead worker breaks the whole pool, along with the jobs it was running. Only the first
+        # request to notice replaces it.
+        if self.executor is executor:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = self.new_executor()
+
+
+    def close(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+_default_service = None
+
+
+async def deobfuscate(data, options=None, timeout=None):
+    """Deobfuscate `data` in the shared service, created with the default settings on first use."""
+    global _default_service
+    if _default_service is None:
+        _default_service = DeobfuscationService()
+    return await _default_service.deobfuscate(data, options, timeout)
+
+
+def json_default(value):
+    if isinstance(value, TraitSummary):
+        return {"records": value.records, "total": value.total, "examples": list(value.examples)}
+    if isinstance(value, (set, deque)):
+        return list(value)
+    if isinstance(value, bytes):
+        return value.decode("utf-8", errors="replace")
+    return repr(value)
+
+
+def parse_options(query):
+    # ?math=1&exitcodes=1&verbose=0&timeout=10
+    options = {}
+    timeout = None
+    for key, value in parse_qsl(query):
+        if key in ("math", "exitcodes", "verbose"):
+            options[key] = value.lower() in ("1", "true", "yes")
+        elif key == "timeout":
+            timeout = float(value)
+        else:
+            raise ValueError(f"Unknown option: {key}")
+    return options, timeout
+
+
+class HTTPServer:
+    # Minimal HTTP/1.1 server: POST /deobfuscate with the script as the body, answered in JSON
+    def __init__(self, service, max_size=16 * 1024 * 1024):
+        self.service = service
+        self.max_size = max_size
+
+
+    async def handle_connection(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+
+                length = int(headers.get("content-length", 0))
+                if length > self.max_size:
+                    await self.respond(writer, 413, {"error": "The script is too large"}, close=True)
+                    break
+                body = await reader.readexactly(length)
+                status, response = await self.route(method, target, body)
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, response, close=not keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        if url.path != "/deobfuscate":
+            return 404, {"error": "Not found"}
+        if method != "POST":
+            return 405, {"error": "Use POST"}
+        try:
+            options, timeout = parse_options(url.query)
+        except ValueError as e:
+            return 400, {"error": str(e)}
+        result = await self.service.deobfuscate(body, options, timeout)
+        return (503 if result.status == "overloaded" else 200), result._asdict()
+
+
+    async def respond(self, writer, status, response, close=False):
+        body = json.dumps(response, default=json_default).encode("utf-8")
+        writer.write(
+          (
+            f"HTTP/1.1 {status} {HTTP_STATUS[status]}\r\n"
+            "Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
+          ).encode("latin-1")
+          + body
+        )
+        await writer.drain()
+
+
+    async def start(self, host="127.0.0.1", port=8080, unix_socket=None):
+        if unix_socket is not None:
+            return await asyncio.start_unix_server(self.handle_connection, path=unix_socket)
+        return await asyncio.start_server(self.handle_connection, host, port)
+
+
+async def serve(args):
+    service = DeobfuscationService(args.workers, args.max_queue, args.timeout, args.max_command_length, args.max_output_bytes)
+    server = await HTTPServer(service, args.max_size).start(args.host, args.port, args.unix)
+    try:
+        async with server:
+            print(f"Listening on {args.unix or f'http://{args.host}:{args.port}'}")
+            await server.serve_forever()
+    finally:
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="The address to listen on")
+    parser.add_argument("--port", type=int, default=8080, help="The port to listen on")
+    parser.add_argument("--unix", type=str, help="The path of a Unix socket to listen on, instead of a TCP port")
+    parser.add_argument("-w", "--workers", type=int, help="The number of worker processes (default: number of CPUs)")
+    parser.add_argument("-q", "--max-queue", type=int, default=64, help="The number of requests that can wait for a worker before new ones are turned away")
+    parser.add_argument("-t", "--timeout", type=float, default=30.0, help="The default maximum number of seconds per request, including queueing")
+    parser.add_argument("--max-size", type=int, default=16 * 1024 * 1024, help="The maximum size of a script, in bytes")
+    parser.add_argument("--max-command-length", type=int, default=MAX_COMMAND_LENGTH, help="The maximum length of a command once its variables are expanded")
+    parser.add_argument("--max-output-bytes", type=int, default=MAX_OUTPUT_BYTES, help="The maximum size of the output of a script, in bytes")
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,125 @@
+"""Incremental deobfuscation of command lines fed one at a time, such as process creation events.
+
+    session = DeobfuscationSession()
+    session.feed("set a=echo").output    # "set a=echo"
+    checkpoint = session.checkpoint()
+    session.feed("set a=dir")
+    session.restore(checkpoint)
+    session.feed("%a% hi").output        # "echo hi"
+
+The state of a session (variables, modified files, exit code and unfinished line) can be saved
+as JSON and resumed by another process:
+    state = session.dumps()
+    session = DeobfuscationSession.loads(state)
+"""
+import functools
+import json
+from collections import namedtuple
+
+from .batch_interpreter import BatchDeobfuscator, VariableScope, iter_deobfuscated_lines
+
+# Bumped whenever the serialized state changes in a way older versions can't read
+STATE_VERSION = 1
+
+# The deobfuscated text of a fed line, empty while it's continued on the next line with `^`,
+# and the traits recorded while interpreting it
+FeedResult = namedtuple("FeedResult", ["output", "traits"])
+Checkpoint = namedtuple(
+  "Checkpoint", ["variables", "variable_versions", "filesystem", "filesystem_version", "exit_code", "pending"]
+)
+
+
+@functools.lru_cache(maxsize=None)
+def default_variables():
+    return dict(BatchDeobfuscator().variables)
+
+
+class DeobfuscationSession:
+    def __init__(self, options=None, **kwargs):
+        # The other arguments are given to the deobfuscator, such as the budget limits
+        self.deobfuscator = BatchDeobfuscator(options=options, **kwargs)
+        self.pending = ""
+
+
+    def feed(self, line):
+        line = line.rstrip("\r\n")
+        if line.endswith("^"):
+            self.pending += line + "\n"
+            return FeedResult("", {})
+        logical_line = self.pending + line
+        self.pending = ""
+
+        deobfuscator = self.deobfuscator
+        deobfuscator.traits = deobfuscator.new_traits()
+        output = "\n".join(iter_deobfuscated_lines(deobfuscator, [logical_line]))
+        return FeedResult(output, dict(deobfuscator.traits))
+
+
+    def checkpoint(self):
+        # The current state is frozen, and the session goes on in copy-on-write layers over it,
+        # so checkpoints don't copy the variables or the filesystem
+        deobfuscator = self.deobfuscator
+        checkpoint = Checkpoint(
+          deobfuscator.variables,
+          deobfuscator.variable_versions,
+          deobfuscator.modified_filesystem,
+          deobfuscator.filesystem_version,
+          deobfuscator.exit_code,
+          self.pending,
+        )
+        self.restore(checkpoint)
+        return checkpoint
+
+
+    def restore(self, checkpoint):
+        # The versions of the variables are restored along with them, which keeps the expansions
+        # cached since the checkpoint from being used
+        deobfuscator = self.deobfuscator
+        deobfuscator.variables = VariableScope(checkpoint.variables)
+        deobfuscator.variable_versions = VariableScope(checkpoint.variable_versions)
+        deobfuscator.modified_filesystem = VariableScope(checkpoint.filesystem)
+        deobfuscator.filesystem_version = checkpoint.filesystem_version
+        deobfuscator.exit_code = checkpoint.exit_code
+        self.pending = checkpoint.pending
+
+
+    def state(self):
+        # Only the variables that differ from the default environment are kept
+        deobfuscator = self.deobfuscator
+        defaults = default_variables()
+        variables = {name: value for name, value in deobfuscator.variables.items() if defaults.get(name) != value}
+        return {
+          "version": STATE_VERSION,
+          "options": vars(deobfuscator.options),
+          "variables": variables,
+          "unset_variables": sorted(name for name in defaults if name not in deobfuscator.variables),
+          "filesystem": dict(deobfuscator.modified_filesystem),
+          "exit_code": deobfuscator.exit_code,
+          "pending": self.pending,
+        }
+
+
+    @classmethod
+    def from_state(cls, state, **kwargs):
+        if state.get("version") != STATE_VERSION:
+            raise ValueError(f"Unsupported session state version: {state.get('version')!r}")
+        session = cls(options=state["options"], **kwargs)
+        deobfuscator = session.deobfuscator
+        for name in state["unset_variables"]:
+            deobfuscator.unset_variable(name)
+        for name, value in state["variables"].items():
+            deobfuscator.set_variable(name, value)
+        for path, change in state["filesystem"].items():
+            deobfuscator.modify_file(path, change)
+        deobfuscator.exit_code = state["exit_code"]
+        session.pending = state["pending"]
+        return session
+
+
+    def dumps(self):
+        return json.dumps(self.state())
+
+
+    @classmethod
+    def loads(cls, data, **kwargs):
+        return cls.from_state(json.loads(data), **kwargs)
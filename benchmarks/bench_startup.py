@@ -0,0 +1,40 @@
+"""Startup benchmark: cost of constructing a BatchDeobfuscator.
+
+Measures the construction of many instances, then the one-off cost paid by the first
+`interpret_curl` of the process, which builds the shared curl parser.
+
+Run from the repository root:
+    python -m benchmarks.bench_startup
+"""
+import argparse
+import time
+
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator, get_curl_parser, get_invoke_webrequest_parser
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--number", type=int, default=10000, help="Instances to construct")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    for _ in range(args.number):
+        BatchDeobfuscator()
+    construction = (time.perf_counter() - start) / args.number
+    print(f"BatchDeobfuscator(): {construction * 1e6:.1f} us")
+
+    get_curl_parser.cache_clear()
+    get_invoke_webrequest_parser.cache_clear()
+    deobfuscator = BatchDeobfuscator()
+    start = time.perf_counter()
+    deobfuscator.interpret_curl("curl -O https://example.com/a.zip")
+    first = time.perf_counter() - start
+    start = time.perf_counter()
+    deobfuscator.interpret_curl("curl -O https://example.com/a.zip")
+    second = time.perf_counter() - start
+    print(f"First interpret_curl (builds the parser): {first * 1e6:.1f} us")
+    print(f"Next interpret_curl: {second * 1e6:.1f} us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,167 @@
+"""Benchmark suite timing each stage of the deobfuscator separately.
+
+Times `get_commands`, `normalize_command`, `get_value`, `analyze` and the command line over the
+synthetic inputs of `benchmarks.generators` at every size, and over the example scripts. The best
+time of each measurement is recorded in JSON, so that runs can be compared to spot regressions.
+With `--math` and `--exitcodes`, samples such as the Huntress one are deobfuscated all the way:
+
+Run from the repository root:
+    python -m benchmarks.bench_suite --output before.json
+    python -m benchmarks.bench_suite --output after.json --compare before.json
+"""
+import argparse
+import glob
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from batch_deobfuscator import batch_interpreter
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator
+
+from .generators import GENERATORS
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STAGES = ["get_commands", "normalize_command", "get_value", "analyze", "cli"]
+
+
+def time_get_commands(lines, path, options):
+    deobfuscator = BatchDeobfuscator(options=options)
+    start = time.perf_counter()
+    for line in lines:
+        list(deobfuscator.get_commands(line))
+    return time.perf_counter() - start
+
+
+def time_normalize_command(lines, path, options, stage="normalize_command"):
+    # The commands still need to be interpreted for the variables to be set, which isn't timed
+    deobfuscator = BatchDeobfuscator(options=options)
+    elapsed = 0.0
+    if stage == "get_value":
+        get_value = deobfuscator.get_value
+
+        def timed_get_value(variable):
+            nonlocal elapsed
+            start = time.perf_counter()
+            value = get_value(variable)
+            elapsed += time.perf_counter() - start
+            return value
+
+        deobfuscator.get_value = timed_get_value
+
+    for line in lines:
+        for command in list(deobfuscator.get_commands(line)):
+            start = time.perf_counter()
+            normalized_comm = deobfuscator.normalize_command(command)
+            if stage == "normalize_command":
+                elapsed += time.perf_counter() - start
+            deobfuscator.interpret_command(normalized_comm)
+    return elapsed
+
+
+def time_get_value(lines, path, options):
+    return time_normalize_command(lines, path, options, "get_value")
+
+
+def time_analyze(lines, path, options):
+    with open(path, "rb") as f:
+        data = f.read()
+    start = time.perf_counter()
+    BatchDeobfuscator(options=options).analyze_bytes(data)
+    return time.perf_counter() - start
+
+
+def time_cli(lines, path, options):
+    # Includes the startup of the interpreter, as seen by anyone running the script
+    flags = [f"--{option}" for option, enabled in options.items() if enabled]
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        subprocess.run(
+          [sys.executable, batch_interpreter.__file__, "-f", path, "-o", os.path.join(directory, "out.bat"), *flags],
+          check=True,
+        )
+        return time.perf_counter() - start
+
+
+TIMERS = {
+  "get_commands": time_get_commands,
+  "normalize_command": time_normalize_command,
+  "get_value": time_get_value,
+  "analyze": time_analyze,
+  "cli": time_cli,
+}
+
+
+def iter_inputs(sizes, directory):
+    # Yields the name, size, logical lines and path of every input
+    for name, generator in GENERATORS.items():
+        for size in sizes:
+            lines = generator(size)
+            path = os.path.join(directory, f"{name}-{size}.bat")
+            with open(path, "w", newline="") as f:
+                f.write("\r\n".join(lines) + "\r\n")
+            yield name, size, lines, path
+
+    for path in sorted(glob.glob(os.path.join(REPOSITORY, "examples", "*.bat"))):
+        deobfuscator = BatchDeobfuscator()
+        lines = list(deobfuscator.read_logical_line(path))
+        yield os.path.basename(path), os.path.getsize(path), lines, path
+
+
+def run(sizes, stages, repeat, options):
+    results = []
+    with tempfile.TemporaryDirectory() as directory:
+        for name, size, lines, path in iter_inputs(sizes, directory):
+            for stage in stages:
+                seconds = min(TIMERS[stage](lines, path, options) for _ in range(repeat))
+                results.append({"benchmark": stage, "input": name, "size": size, "seconds": seconds})
+                print(f"{stage:>18}{name:>40}{size:>10}{seconds:>12.4f}", file=sys.stderr)
+    return results
+
+
+def compare(results, previous):
+    # Prints the ratio between the times of this run and of a previous one
+    previous_seconds = {(r["benchmark"], r["input"], r["size"]): r["seconds"] for r in previous["results"]}
+    print(f"{'benchmark':>18}{'input':>40}{'size':>10}{'before':>12}{'after':>12}{'ratio':>8}")
+    for result in results:
+        before = previous_seconds.get((result["benchmark"], result["input"], result["size"]))
+        if before is None:
+            continue
+        # Stages that aren't used by an input, such as `get_value` without any variable, take no time
+        ratio = f"{result['seconds'] / before:.2f}" if before else "-"
+        print(
+          f"{result['benchmark']:>18}{result['input']:>40}{result['size']:>10}"
+          f"{before:>12.4f}{result['seconds']:>12.4f}{ratio:>8}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1024, 10240, 102400], help="Sizes of the synthetic inputs, in bytes")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES, help="Stages to time")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Runs per measurement, the best one is kept")
+    parser.add_argument("-o", "--output", type=str, help="Path of the JSON results (default: stdout)")
+    parser.add_argument("--compare", type=str, help="Path of the JSON results of a previous run to compare with")
+    parser.add_argument("-m", "--math", action="store_true", help="Deobfuscate with the --math option")
+    parser.add_argument("-e", "--exitcodes", action="store_true", help="Deobfuscate with the --exitcodes option")
+    args = parser.parse_args()
+
+    options = {"math": args.math, "exitcodes": args.exitcodes}
+    results = run(args.sizes, args.stages, args.repeat, options)
+    report = {"python": platform.python_version(), "platform": platform.platform(), "options": options, "results": results}
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+    if args.compare is not None:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+"""Generators of synthetic DOSfuscation-style batch scripts for the benchmarks.
+
+Every generator takes a size in bytes and returns the lines of a script. The last line is a
+one-liner of about that size, and the lines before it set up the variables it uses.
+"""
+import itertools
+import string
+
+ALPHABET = string.ascii_letters + string.digits
+TEXT = "echo The quick brown fox jumps over the lazy dog "
+
+
+def fill(fragments, size):
+    # Repeats the fragments until the line is about `size` bytes long
+    line = []
+    length = 0
+    for fragment in itertools.cycle(fragments):
+        if length >= size:
+            break
+        line.append(fragment)
+        length += len(fragment)
+    return "".join(line)
+
+
+def substring_slicing(size):
+    # `%alphabet:~n,1%` for every character, the most common obfuscation
+    fragments = [f"%alphabet:~{ALPHABET.index(char)},1%" if char in ALPHABET else char for char in TEXT]
+    return ["@echo off", f"set alphabet={ALPHABET}", fill(fragments, size)]
+
+
+def caret_spam(size):
+    # Escapes every character, which cmd ignores outside of quotes
+    return ["@echo off", fill([f"^{char}" if char != " " else char for char in TEXT], size)]
+
+
+def comma_semicolon_padding(size):
+    # Commas and semicolons are delimiters, just like spaces
+    return ["@echo off", fill([word + ",;;," for word in TEXT.split()], size)]
+
+
+def nested_cmd(size):
+    # Chains of commands, each of them nested in a few `cmd /c`
+    return ["@echo off", fill(["cmd /c " * 8 + "echo nested & "], size)]
+
+
+def arithmetic(size):
+    # `set /a` computing character codes, only evaluated with --math
+    fragments = [f"set /a code=(%code% * 7 + {ALPHABET.index(char) if char in ALPHABET else 0}) %% 26 + 97 & " for char in TEXT]
+    return ["@echo off", "set /a code=1", fill(fragments, size)]
+
+
+GENERATORS = {
+  "substring_slicing": substring_slicing,
+  "caret_spam": caret_spam,
+  "comma_semicolon_padding": comma_semicolon_padding,
+  "nested_cmd": nested_cmd,
+  "arithmetic": arithmetic,
+}
@@ -0,0 +1,120 @@
+"""Load generator measuring the latency of the deobfuscation service under concurrent requests.
+
+Without an address, a service is started in this process on an ephemeral port. The scripts sent
+are the synthetic inputs of `benchmarks.generators`, in turn.
+
+Run from the repository root:
+    python -m benchmarks.loadgen -n 500 -c 32 --workers 4
+    python -m benchmarks.loadgen -n 500 -c 32 --host 127.0.0.1 --port 8080
+"""
+import argparse
+import asyncio
+import collections
+import itertools
+import json
+import sys
+import time
+
+from batch_deobfuscator.service import DeobfuscationService, HTTPServer
+
+from .generators import GENERATORS
+
+
+async def post(host, port, body, query=""):
+    # One request per connection, as a client in a hurry would do
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(
+          (
+            f"POST /deobfuscate{query} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            "Connection: close\r\n\r\n"
+          ).encode("latin-1")
+          + body
+        )
+        await writer.drain()
+        response = await reader.read()
+    finally:
+        writer.close()
+    headers, _, body = response.partition(b"\r\n\r\n")
+    return int(headers.split(b" ", 2)[1]), json.loads(body)
+
+
+def percentile(values, fraction):
+    return values[min(int(len(values) * fraction), len(values) - 1)]
+
+
+async def run(host, port, scripts, requests, concurrency, query):
+    latencies = []
+    statuses = collections.Counter()
+    scripts = itertools.cycle(scripts)
+
+    async def client(count):
+        for _ in range(count):
+            body = next(scripts)
+            start = time.perf_counter()
+            try:
+                _, response = await post(host, port, body, query)
+                statuses[response.get("status", "error")] += 1
+            except (ConnectionError, ValueError):
+                statuses["connection-error"] += 1
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(requests // concurrency + (i < requests % concurrency)) for i in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+      "requests": len(latencies),
+      "concurrency": concurrency,
+      "seconds": elapsed,
+      "throughput": len(latencies) / elapsed,
+      "p50": percentile(latencies, 0.5),
+      "p90": percentile(latencies, 0.9),
+      "p99": percentile(latencies, 0.99),
+      "max": latencies[-1],
+      "statuses": dict(statuses),
+    }
+
+
+async def main(args):
+    scripts = [("\r\n".join(generator(args.size)) + "\r\n").encode() for generator in GENERATORS.values()]
+    query = f"?timeout={args.timeout}" if args.timeout is not None else ""
+
+    if args.port is not None:
+        return await run(args.host, args.port, scripts, args.requests, args.concurrency, query)
+
+    service = DeobfuscationService(args.workers, args.max_queue)
+    server = await HTTPServer(service).start(args.host, 0)
+    try:
+        port = server.sockets[0].getsockname()[1]
+        # Warms the workers up so that the startup of the processes isn't measured
+        await asyncio.gather(*(post(args.host, port, scripts[0]) for _ in range(service.workers)))
+        return await run(args.host, port, scripts, args.requests, args.concurrency, query)
+    finally:
+        server.close()
+        await server.wait_closed()
+        service.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1", help="The address of the service")
+    parser.add_argument("--port", type=int, help="The port of a running service (default: start one in this process)")
+    parser.add_argument("-n", "--requests", type=int, default=200, help="The total number of requests")
+    parser.add_argument("-c", "--concurrency", type=int, default=16, help="The number of requests in flight at once")
+    parser.add_argument("-s", "--size", type=int, default=10240, help="The size of the scripts sent, in bytes")
+    parser.add_argument("-t", "--timeout", type=float, help="The timeout of each request, in seconds")
+    parser.add_argument("-w", "--workers", type=int, help="The number of workers of the service started in this process")
+    parser.add_argument("-q", "--max-queue", type=int, default=64, help="The queue size of the service started in this process")
+    args = parser.parse_args()
+
+    report = asyncio.run(main(args))
+    print(json.dumps(report, indent=2))
+    print(
+      f"p50 {report['p50'] * 1000:.1f}ms  p90 {report['p90'] * 1000:.1f}ms  p99 {report['p99'] * 1000:.1f}ms  "
+      f"max {report['max'] * 1000:.1f}ms  {report['throughput']:.1f} req/s",
+      file=sys.stderr,
+    )
@@ -7,9 +7,6 @@ setup(
   author="@DissectMalware",
   url="https://github.com/DissectMalware/batch_deobfuscator/",
   packages=["batch_deobfuscator"],
-  install_requires=[
-    "simpleeval",
-  ],
   extras_require={
     "dev": [
       "pytest",
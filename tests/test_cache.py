@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator, ResultCache, handle_bat_file
+
+SAMPLE = b'set x=echo& cmd /c "%x% child" & powershell -e ZQBjAGgAbwAgACIAVwBpAHoAYQByAGQAIgA=\n' * 2
+
+
+def test_analyze_cached(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db")
+    (tmp_path / "first.bat").write_bytes(SAMPLE)
+    (tmp_path / "second.bat").write_bytes(SAMPLE)
+    (tmp_path / "out1").mkdir()
+    (tmp_path / "out2").mkdir()
+
+    deobfuscator = BatchDeobfuscator(cache=cache)
+    expected = deobfuscator.analyze(tmp_path / "first.bat", tmp_path / "out1")
+    assert (cache.hits, cache.misses, len(cache)) == (0, 1, 1)
+
+    # Same content under another name
+    cached = BatchDeobfuscator(cache=cache)
+    assert cached.analyze(tmp_path / "second.bat", tmp_path / "out2") == expected
+    assert cache.hits == 1
+    assert repr(dict(cached.traits)) == repr(dict(deobfuscator.traits))
+    assert cached.traits["duplicate-artifacts"] == {"batch": 1, "powershell": 1}
+    written = sorted(path.name for path in (tmp_path / "out1").iterdir())
+    assert sorted(path.name for path in (tmp_path / "out2").iterdir()) == written
+    for name in written:
+        assert (tmp_path / "out2" / name).read_bytes() == (tmp_path / "out1" / name).read_bytes()
+
+    _, _, artifacts = BatchDeobfuscator(cache=cache).analyze_bytes(SAMPLE)
+    assert cache.hits == 2
+    assert sorted(artifacts) == written
+
+
+def test_handle_bat_file_cached(tmp_path):
+    (tmp_path / "a.bat").write_bytes(b"set x=echo\r\n%x% A\r\n")
+    with ResultCache(tmp_path / "cache.db") as cache:
+        deobfuscator = BatchDeobfuscator(cache=cache)
+        assert handle_bat_file(deobfuscator, tmp_path / "a.bat") == "set x=echo\necho A"
+        cached = BatchDeobfuscator(cache=cache)
+        assert handle_bat_file(cached, tmp_path / "a.bat") == "set x=echo\necho A"
+        assert cache.hits == 1
+        assert cached.traits["var_used"].total == 1
+
+        # Other options give other results
+        handle_bat_file(BatchDeobfuscator(options={"verbose": True}, cache=cache), tmp_path / "a.bat")
+        assert (cache.hits, len(cache)) == (1, 2)
+
+    # Kept across runs
+    with ResultCache(tmp_path / "cache.db") as cache:
+        assert handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat") == "set x=echo\necho A"
+        assert cache.hits == 1
+
+
+def test_not_cached(tmp_path):
+    (tmp_path / "a.bat").write_bytes(b"echo %x%\r\n")
+    cache = ResultCache(tmp_path / "cache.db")
+    # The result depends on the state left by the previous commands
+    deobfuscator = BatchDeobfuscator(cache=cache)
+    deobfuscator.set_variable("x", "A")
+    assert handle_bat_file(deobfuscator, tmp_path / "a.bat") == "echo A"
+    assert len(cache) == 0
+    # Timeouts depend on the machine
+    deobfuscator = BatchDeobfuscator(cache=cache, timeout=0)
+    handle_bat_file(deobfuscator, tmp_path / "a.bat")
+    assert deobfuscator.traits["budget-exceeded"] == "timeout"
+    assert len(cache) == 0
+
+
+def test_threads(tmp_path):
+    (tmp_path / "a.bat").write_bytes(b"set x=echo\r\n%x% A\r\n")
+    cache = ResultCache(tmp_path / "cache.db")
+
+    def run(_):
+        return handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat")
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        # The first one fills the cache
+        assert list(executor.map(run, range(1))) == ["set x=echo\necho A"]
+        assert list(executor.map(run, range(8))) == ["set x=echo\necho A"] * 8
+    assert (cache.hits, cache.misses, len(cache)) == (8, 1, 1)
+
+
+def test_handlers(tmp_path):
+    (tmp_path / "a.bat").write_bytes(b"certutil -decode a.txt a.exe\r\n")
+    cache = ResultCache(tmp_path / "cache.db")
+    handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat")
+
+    def handle_certutil(deobfuscator, normalized_comm, command):
+        deobfuscator.traits["certutil"].append(normalized_comm)
+
+    deobfuscator = BatchDeobfuscator(cache=cache)
+    deobfuscator.register_handler("certutil", handle_certutil)
+    handle_bat_file(deobfuscator, tmp_path / "a.bat")
+    assert deobfuscator.traits["certutil"] == ["certutil -decode a.txt a.exe"]
+    assert (cache.hits, len(cache)) == (0, 2)
+
+
+def test_corrupt_entry(tmp_path):
+    (tmp_path / "a.bat").write_bytes(b"echo A\r\n")
+    cache = ResultCache(tmp_path / "cache.db")
+    handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat")
+    with cache.connection:
+        cache.connection.execute("UPDATE results SET value = ?", (b"not a pickle",))
+    assert handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat") == "echo A"
+    assert (cache.hits, cache.misses) == (0, 2)
+    # Replaced by the new result
+    assert handle_bat_file(BatchDeobfuscator(cache=cache), tmp_path / "a.bat") == "echo A"
+    assert cache.hits == 1
+
+
+def test_eviction(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db", max_bytes=4096)
+    paths = []
+    for i in range(20):
+        paths.append(tmp_path / f"{i}.bat")
+        paths[-1].write_bytes(b"echo %d\r\n" % i)
+        handle_bat_file(BatchDeobfuscator(cache=cache), paths[-1])
+        # The first one stays the most recently used
+        handle_bat_file(BatchDeobfuscator(cache=cache), paths[0])
+    size = cache.connection.execute("SELECT total(size) FROM results").fetchone()[0]
+    assert 0 < len(cache) < 20
+    assert size <= 4096
+    # The running total follows the evictions
+    assert cache.size() == size
+
+    hits = cache.hits
+    handle_bat_file(BatchDeobfuscator(cache=cache), paths[0])
+    handle_bat_file(BatchDeobfuscator(cache=cache), paths[-1])
+    assert cache.hits == hits + 2
+    handle_bat_file(BatchDeobfuscator(cache=cache), paths[1])
+    assert cache.hits == hits + 2
+
+
+def test_running_total(tmp_path):
+    cache = ResultCache(tmp_path / "cache.db")
+    cache.put("a", "x" * 100)
+    cache.put("b", "y")
+    # Replacing an entry only counts its new size
+    cache.put("a", "x")
+    total = cache.connection.execute("SELECT total(size) FROM results").fetchone()[0]
+    assert cache.size() == total
+    cache.close()
+
+    # Databases without the total get it from their entries
+    with ResultCache(tmp_path / "cache.db") as cache:
+        with cache.connection:
+            cache.connection.execute("DROP TABLE totals")
+    with ResultCache(tmp_path / "cache.db") as cache:
+        assert cache.size() == total
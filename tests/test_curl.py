@@ -61,3 +61,7 @@ def test_curl_extraction(statement, download_trait):
     else:
         assert len(deobfuscator.traits["download"]) == 1
         assert deobfuscator.traits["download"][0] == download_trait
+
+
+def test_curl_parser_is_shared():
+    assert BatchDeobfuscator().curl_parser is BatchDeobfuscator().curl_parser
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import os
+import signal
+
+from batch_deobfuscator import service as service_module
+from batch_deobfuscator.service import DeobfuscationService, HTTPServer, Result, deobfuscate_bytes
+
+
+def test_deobfuscate_bytes():
+    result = deobfuscate_bytes(b"set a=echo\r\n%a% hi\r\n")
+    assert result.status == "ok"
+    assert result.output == "set a=echo\necho hi"
+    assert result.traits["var_used"].total == 1
+    assert result.error is None
+
+
+def test_deobfuscate_bytes_timeout():
+    result = deobfuscate_bytes(b"echo hi\r\n" * 1000, timeout=0)
+    assert result.status == "timeout"
+    assert result.traits["budget-exceeded"] == "timeout"
+
+
+def test_deobfuscate_bytes_limits():
+    # Doubles the length of the command on every line
+    result = deobfuscate_bytes(b"set a=x\r\n" + b"set a=%a%%a%\r\n" * 40)
+    assert result.status == "ok"
+    assert result.traits["budget-exceeded"] == "max_command_length"
+
+
+def test_service():
+    async def run():
+        service = DeobfuscationService(workers=1)
+        try:
+            return await service.deobfuscate(b"set a=echo\r\n%a% hi\r\n", {"verbose": False})
+        finally:
+            service.close()
+
+    result = asyncio.run(run())
+    assert isinstance(result, Result)
+    assert (result.status, result.output) == ("ok", "set a=echo\necho hi")
+
+
+def test_service_overloaded():
+    async def run():
+        service = DeobfuscationService(workers=1, max_queue=0)
+        try:
+            return await asyncio.gather(*(service.deobfuscate(b"echo hi\r\n") for _ in range(3)))
+        finally:
+            service.close()
+
+    statuses = [result.status for result in asyncio.run(run())]
+    assert statuses == ["ok", "overloaded", "overloaded"]
+
+
+def test_service_worker_died():
+    async def run():
+        service = DeobfuscationService(workers=1)
+        try:
+            first = await service.deobfuscate(b"echo hi\r\n")
+            for pid in list(service.executor._processes):
+                os.kill(pid, signal.SIGKILL)
+            return first, await service.deobfuscate(b"echo hi\r\n"), await service.deobfuscate(b"echo hi\r\n")
+        finally:
+            service.close()
+
+    statuses = [result.status for result in asyncio.run(run())]
+    # The pool is replaced after the worker died
+    assert statuses == ["ok", "error", "ok"]
+
+
+def test_service_slot_held(monkeypatch):
+    # The request is given up on long before the worker reaches its own deadline
+    monkeypatch.setattr(service_module, "TIMEOUT_GRACE", -0.9)
+
+    async def run():
+        service = DeobfuscationService(workers=1, timeout=1.0)
+        try:
+            given_up = await service.deobfuscate(b"echo hi\r\n" * 1000000)
+            held = service.slots.locked()
+            monkeypatch.setattr(service_module, "TIMEOUT_GRACE", 1.0)
+            return given_up, held, await service.deobfuscate(b"echo hi\r\n", timeout=10)
+        finally:
+            service.close()
+
+    given_up, held, after = asyncio.run(run())
+    assert given_up.error == "The worker didn't return in time"
+    # The worker is still busy, so the next request waits for it rather than for the executor
+    assert held
+    assert after.status == "ok"
+
+
+def test_http():
+    async def request(port, request):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(request)
+        response = await reader.read()
+        writer.close()
+        headers, _, body = response.partition(b"\r\n\r\n")
+        return int(headers.split(b" ", 2)[1]), json.loads(body)
+
+    async def run():
+        service = DeobfuscationService(workers=1)
+        server = await HTTPServer(service, max_size=1024).start("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            body = b"set a=echo\r\n%a% hi\r\n"
+            return await asyncio.gather(
+              request(port, b"POST /deobfuscate?math=1 HTTP/1.1\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (len(body), body)),
+              request(port, b"POST /deobfuscate?potato=1 HTTP/1.1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"),
+              request(port, b"GET /deobfuscate HTTP/1.1\r\nConnection: close\r\n\r\n"),
+              request(port, b"POST / HTTP/1.1\r\nContent-Length: 0\r\nConnection: close\r\n\r\n"),
+              request(port, b"POST /deobfuscate HTTP/1.1\r\nContent-Length: 2048\r\n\r\n"),
+            )
+        finally:
+            server.close()
+            await server.wait_closed()
+            service.close()
+
+    ok, unknown_option, get, not_found, too_large = asyncio.run(run())
+    assert ok[0] == 200
+    assert (ok[1]["status"], ok[1]["output"]) == ("ok", "set a=echo\necho hi")
+    assert ok[1]["traits"]["var_used"]["total"] == 1
+    assert unknown_option == (400, {"error": "Unknown option: potato"})
+    assert get[0] == 405
+    assert not_found[0] == 404
+    assert too_large[0] == 413
